@@ -1,56 +1,260 @@
-import os, sys, errno, time, multiprocessing
+import os, time, json, contextlib, tempfile, argparse, functools, multiprocessing
 import numpy as np
 
 import lib.util as util
+import lib.midi as midi
 import lib.algos as algos
+import lib.cache as cache
+import lib.store as store
+import lib.instrument as instrument
 
-def align_and_save(align, perf, perfdir, score_dir, outdir):
-    perf_transcript = os.path.join(perfdir, perf)
-    score = os.path.join(scoredir,util.map_score(perf) + '.midi')
-    alignment = align(score, perf_transcript)
-    np.savetxt(os.path.join(outdir, perf + '.txt'), alignment, fmt='%f\t', header='score\t\tperformance')
+def align_performance(job):
+    """
+        align one performance; returns a list of (outdir, record, arrays), with the arrays to store
+        in outdir (see lib/store.py), and the measurements of the job (see lib/instrument.py)
+    """
+    align, perf, score, outdir, record = job
+    with instrument.job(record['performance']) as measured:
+        alignment = align(score, perf)
+    record.update(seconds=measured['seconds'], peak_rss_mb=measured['peak_rss_mb'])
+
+    return [(outdir, record, _arrays(alignment))], measured
+
+def align_batch(job):
+    """
+        align several performances of one score (see the *_batch functions of lib/algos.py); returns a list
+        of (outdir, record, arrays) and measurements as align_performance does, where each record's seconds
+        and peak memory are those of the whole batch
+    """
+    batch, score, pending = job # pending is a list of (perf, outdir, record)
+    with instrument.job(os.path.splitext(os.path.basename(score))[0]) as measured:
+        alignments = batch(score, [perf for perf,_,_ in pending])
+
+    results = []
+    for (perf,outdir,record),alignment in zip(pending, alignments):
+        record.update(seconds=measured['seconds'], peak_rss_mb=measured['peak_rss_mb'], batch=len(pending))
+        results.append((outdir, record, _arrays(alignment)))
+
+    return results, measured
+
+def _arrays(alignment):
+    """ the arrays to store for an alignment """
+    if isinstance(alignment, tuple): # online algorithms also report the latency of each block
+        return dict(alignment=alignment[0], latency=alignment[1])
+    return dict(alignment=alignment)
+
+def sweep_performance(job):
+    """
+        ground truth of one performance for several (stride, lmbda) settings (see algos.align_ground_truth_sweep);
+        returns a list of (outdir, record, arrays) and measurements as align_performance does, where each
+        record's seconds and peak memory are those of the whole sweep
+    """
+    sweep, perf, score, settings = job # settings maps (stride, lmbda) to (outdir, record)
+    with instrument.job(os.path.basename(perf)) as measured:
+        alignments = sweep(score, perf, sorted({lmbda for _,lmbda in settings}), sorted({stride for stride,_ in settings}))
+
+    results = []
+    for setting,(outdir,record) in settings.items():
+        record.update(seconds=measured['seconds'], peak_rss_mb=measured['peak_rss_mb'])
+        results.append((outdir, record, dict(alignment=alignments[setting])))
+
+    return results, measured
+
+def configure_worker(cache_root, cache_size_gb, midi_cached, instrumented, profile):
+    """
+        pool initializer: apply the cache and instrumentation settings of the main process in a worker
+        (workers started by spawn, the default on macOS and Windows, re-import the modules with their defaults)
+    """
+    cache.configure(cache_root, cache_size_gb)
+    midi.configure(midi_cached)
+    instrument.configure(instrumented, profile)
+
+def save_text(outdir, performance, alignment):
+    """ write an alignment as text (the format of older versions of align.py) """
+    _atomic_write(os.path.join(outdir, performance + '.txt'),
+                  lambda f: np.savetxt(f, alignment, fmt='%f\t', header='score\t\tperformance'))
+
+def _atomic_write(path, write):
+    fd,tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f: write(f)
+    os.replace(tmp, path)
+
+def input_signature(files):
+    """ size and modification time of each input file that exists """
+    return {f: [os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in files if os.path.exists(f)}
+
+def up_to_date(stored, record):
+    """ whether the stored entries include the performance, computed with the same parameters from the same inputs """
+    entry = stored.get(record['performance'])
+    return entry is not None and entry.get('params') == record['params'] and entry.get('inputs') == record['inputs']
+
+def job_cost(score, perf, stride=512, fs=44100):
+    """ predicted cost of an alignment: score events x performance frames """
+    _,score_durations,_,_ = midi.load_midi_events_packed(score)
+    _,perf_durations,_,_ = midi.load_midi_events_packed(perf + '.midi')
+    return len(score_durations)*np.sum(perf_durations)*(fs/stride)
 
 algo_functions = {
     'ground' : 'align_ground_truth',
     'spectra' : 'align_spectra',
     'chroma' : 'align_chroma',
-    'cqt' : 'align_prettymidi'
+    'cqt' : 'align_prettymidi',
+    'online' : 'align_online'
 }
 
 if __name__ == "__main__":
-    algo = sys.argv[1]
-    scoredir = sys.argv[2]
-    perfdir = sys.argv[3]
-    parallel = int(sys.argv[4])
-
-    outdir = os.path.join('align',algo)
-    if not os.path.exists(outdir):
-        try:
-            os.makedirs(outdir)
-        except OSError as e:
-            if e.errno != errno.EEXIST:
-                raise
+    parser = argparse.ArgumentParser(description='Compute alignments for every performance in perfdir')
+    parser.add_argument('algo', choices=sorted(algo_functions))
+    parser.add_argument('scoredir')
+    parser.add_argument('perfdir')
+    parser.add_argument('parallel', type=int, help='number of parallel processes (0 runs non-parallel)')
+    parser.add_argument('--engine', choices=algos.gtalign.engines, help='ground-truth DP engine (default fast)')
+    parser.add_argument('--band', type=float, nargs=2, metavar=('LO','HI'),
+                        help='restrict ground-truth tempo to [LO*prior,HI*prior)')
+    parser.add_argument('--max-memory', type=float, metavar='MB',
+                        help='bound the memory of the ground-truth DP (per process)')
+    parser.add_argument('--threads', type=int,
+                        help='OpenMP threads for each ground-truth DP (per process)')
+    parser.add_argument('--levels', type=int,
+                        help='coarse-to-fine ground truth: number of coarser levels to align first')
+    parser.add_argument('--factor', type=int, help='downsampling factor between levels (default 4)')
+    parser.add_argument('--radius', type=int, help='corridor radius in frames around the coarser path (default 32)')
+    parser.add_argument('--lmbda', type=float, nargs='+',
+                        help='ground-truth tempo regularization weight(s) (default 0.1); see --stride')
+    parser.add_argument('--stride', type=int, nargs='+',
+                        help='ground-truth frame stride(s) in samples (default 512); several values of --lmbda '
+                             'and --stride sweep every combination, writing each to align/ground-lmbdaL-strideS')
+    parser.add_argument('--dtw', choices=['librosa','banded'], help='DTW engine for spectra/chroma/cqt (default librosa)')
+    parser.add_argument('--dtw-band', type=int, metavar='FRAMES', help='banded DTW: Sakoe-Chiba band radius')
+    parser.add_argument('--dtw-slope', type=float, help='banded DTW: limit the slope of the path to [1/SLOPE,SLOPE]')
+    parser.add_argument('--dtw-radius', type=int, metavar='FRAMES',
+                        help='banded DTW: multiscale, within FRAMES of the path at half resolution')
+    parser.add_argument('--block', type=int, metavar='SAMPLES', help='online: audio block size (default 2048)')
+    parser.add_argument('--follow-radius', type=int, metavar='FRAMES',
+                        help='online: score frames considered around the current position (default 256)')
+    parser.add_argument('--cache', metavar='DIR',
+                        help='feature cache directory for spectra/chroma/cqt (default ./cache)')
+    parser.add_argument('--cache-size', type=float, metavar='GB', help='feature cache size limit (default 20)')
+    parser.add_argument('--no-cache', action='store_true', help='recompute audio and features from scratch')
+    parser.add_argument('--force', action='store_true', help='recompute alignments that are already up to date')
+    parser.add_argument('--text', action='store_true', help='also write each alignment as text (align/ALGO/PERF.txt)')
+    parser.add_argument('--instrument', metavar='FILE',
+                        help='time the stages of each alignment, appending them to FILE (JSON lines) and summarizing them')
+    parser.add_argument('--profile', metavar='PERFORMANCE',
+                        help='run the alignment of PERFORMANCE (with --batch, the batch of score PERFORMANCE) under cProfile')
+    parser.add_argument('--batch', action='store_true',
+                        help='align all the performances of a score together, preparing the score once')
+    opts = parser.parse_args()
+
+    algo = opts.algo
+    scoredir = opts.scoredir
+    perfdir = opts.perfdir
+    parallel = opts.parallel
+
+    kwargs = {}
+    if opts.engine is not None: kwargs['engine'] = opts.engine
+    if opts.band is not None: kwargs['band'] = tuple(opts.band)
+    if opts.max_memory is not None: kwargs['max_memory'] = int(opts.max_memory*2**20)
+    if opts.threads is not None: kwargs['threads'] = opts.threads
+    if opts.levels is not None: kwargs['levels'] = opts.levels
+    if opts.factor is not None: kwargs['factor'] = opts.factor
+    if opts.radius is not None: kwargs['radius'] = opts.radius
+    if kwargs and algo != 'ground': parser.error('ground-truth options only apply to ground')
+    settings = None # (stride, lmbda) settings of the ground truth, if given
+    if opts.lmbda is not None or opts.stride is not None:
+        if algo != 'ground': parser.error('--lmbda and --stride only apply to ground')
+        settings = [(stride,lmbda) for stride in opts.stride or [512] for lmbda in opts.lmbda or [0.1]]
+        if len(settings) > 1 and kwargs.keys() & {'max_memory','levels','factor','radius'}:
+            parser.error('sweeps (several --lmbda or --stride values) don\'t support --max-memory or --levels')
+        if len(settings) > 1 and opts.batch: parser.error('sweeps (several --lmbda or --stride values) don\'t support --batch')
+    dtw_kwargs = dict(dtw=opts.dtw, band=opts.dtw_band, slope=opts.dtw_slope, radius=opts.dtw_radius)
+    dtw_kwargs = {k: v for k,v in dtw_kwargs.items() if v is not None}
+    if dtw_kwargs and algo not in ('spectra','chroma','cqt'): parser.error('DTW options only apply to spectra, chroma and cqt')
+    if dtw_kwargs.keys() - {'dtw'} and opts.dtw != 'banded': parser.error('--dtw-band/slope/radius require --dtw banded')
+    kwargs.update(dtw_kwargs)
+    online_kwargs = dict(block=opts.block, radius=opts.follow_radius)
+    online_kwargs = {k: v for k,v in online_kwargs.items() if v is not None}
+    if online_kwargs and algo != 'online': parser.error('--block and --follow-radius only apply to online')
+    kwargs.update(online_kwargs)
+    instrument.configure(opts.instrument is not None, opts.profile)
+    if opts.no_cache: cache.configure(None)
+    elif opts.cache is not None or opts.cache_size is not None:
+        cache.configure(opts.cache if opts.cache is not None else cache.root, opts.cache_size)
+    midi.configure(cache.root is not None)
+
+    # alignments are written to align/ALGO; ground truth computed with other settings of lmbda and stride
+    # is written to align/ground-lmbdaL-strideS (so align/ground remains the reference for eval.py)
+    if settings is None:
+        outputs = {None: (os.path.join('align',algo), kwargs)}
+    else:
+        outputs = {(stride,lmbda): (os.path.join('align','ground-lmbda{:g}-stride{}'.format(lmbda, stride)),
+                                    dict(kwargs, stride=stride, lmbda=lmbda)) for stride,lmbda in settings}
+    for outdir,_ in outputs.values(): os.makedirs(outdir, exist_ok=True)
 
     start_time = time.time()
     performances = sorted([f[:-len('.midi')] for f in os.listdir(perfdir) if f.endswith('.midi')])
-    alignment_algo = getattr(algos, algo_functions[algo])
-    if parallel > 0:
-        print('Computing {} alignments (parallel)'.format(algo))
-        args = [(alignment_algo, perf, perfdir, scoredir, outdir) for perf in performances]
-        with multiprocessing.Pool(parallel) as p: p.starmap(align_and_save, args)
+    if len(outputs) > 1: # parse, build the pianoroll and compute the local costs once for every setting
+        worker,alignment_algo = sweep_performance,functools.partial(algos.align_ground_truth_sweep, **kwargs)
+    elif opts.batch: # prepare each score once for all its performances
+        (_,algo_kwargs), = outputs.values()
+        worker,alignment_algo = align_batch,functools.partial(getattr(algos, algo_functions[algo] + '_batch'), **algo_kwargs)
     else:
-        print('Computing {} alignments'.format(algo))
-        for perf in performances:
-            print('  ', perf, end=' ')
-            t0 = time.time()
-            perf_audio = os.path.join(perfdir, perf + '.wav')
-            score = os.path.join(scoredir,util.map_score(perf) + '.midi')
+        (_,algo_kwargs), = outputs.values()
+        worker,alignment_algo = align_performance,functools.partial(getattr(algos, algo_functions[algo]), **algo_kwargs)
+
+    jobs,batches = [],{}
+    stored = {setting: store.index(outdir) for setting,(outdir,_) in outputs.items()}
+    for perf in performances:
+        perf_path = os.path.join(perfdir, perf)
+        score = os.path.join(scoredir,util.map_score(perf) + '.midi')
+        inputs = input_signature([score, perf_path + '.midi', perf_path + '.wav'])
+        pending = {}
+        for setting,(outdir,algo_kwargs) in outputs.items():
+            record = dict(performance=perf, params=json.loads(json.dumps(dict(algo=algo, **algo_kwargs))), inputs=inputs)
+            if opts.force or not up_to_date(stored[setting], record): pending[setting] = (outdir, record)
+        if not pending: continue
+
+        if opts.batch:
+            cost,pending_perfs = batches.get(score, (0, []))
+            batches[score] = (cost + job_cost(score, perf_path), pending_perfs + [(perf_path,) + next(iter(pending.values()))])
+            continue
+
+        job = (alignment_algo, perf_path, score, pending) if len(outputs) > 1 else \
+              (alignment_algo, perf_path, score) + next(iter(pending.values()))
+        jobs.append((job_cost(score, perf_path), job))
+    jobs += [(cost, (alignment_algo, score, pending_perfs)) for score,(cost,pending_perfs) in batches.items()]
+
+    # longest jobs first, so that no long job is left running alone at the end
+    jobs = [job for _,job in sorted(jobs, key=lambda job: -job[0])]
+    queued = sum(len(job[2]) for job in jobs) if opts.batch else len(jobs)
+    print('Computing {} alignments{}{}{} ({} up to date)'.format(algo, ' (parallel)' if parallel > 0 else '',
+                                                                ' for {} settings'.format(len(outputs)) if len(outputs) > 1 else '',
+                                                                ' in {} batches'.format(len(jobs)) if opts.batch else '',
+                                                                len(performances)-queued))
 
-            alignment = alignment_algo(score, perf_audio)
-            np.savetxt(os.path.join(outdir, perf + '.txt'), alignment, fmt='%f\t', header='score\t\tperformance')
+    total,measurements = 0,[]
+    with contextlib.ExitStack() as stack:
+        if parallel > 0:
+            pool = stack.enter_context(multiprocessing.Pool(parallel, configure_worker,
+                                                            (cache.root, cache.max_bytes/2**30, midi.cached,
+                                                             instrument.enabled, instrument.profile_job)))
+            results = pool.imap_unordered(worker, jobs)
+        else:
+            results = map(worker, jobs)
 
-            t1 = time.time()-t0
-            print('({} seconds)'.format(t1))
-        total += t1
+        for result,measured in results:
+            t0 = time.perf_counter()
+            for outdir,record,arrays in result:
+                store.append(outdir, record, arrays) # as each job finishes, so an interrupted run resumes from here
+                if opts.text: save_text(outdir, record['performance'], arrays['alignment'])
+            if 'stages' in measured: # writing happens in the main process, after the job
+                measured['stages']['store'] = dict(seconds=time.perf_counter()-t0, calls=len(result))
+            print('   {} ({:.2f} seconds, {:.0f}MB)'.format(', '.join(dict.fromkeys(record['performance'] for _,record,_ in result)),
+                                                        record['seconds'], record['peak_rss_mb']))
+            if 'profile' in measured: print('      profile written to {}'.format(measured['profile']))
+            if opts.instrument is not None: instrument.write(opts.instrument, measured, algo=algo)
+            measurements.append(measured)
+            total += record['seconds']
 
-    print('Elapsed time: {} seconds'.format(time.time()-start_time))
+    print('Elapsed time: {} seconds ({} seconds of alignment)'.format(time.time()-start_time, total))
+    if opts.instrument is not None and measurements: instrument.report(measurements)
@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+#
+# startup benchmark: the time to import each entry point of the repository in a fresh interpreter
+# (the cost paid by every short command-line run and every worker process that imports it)
+#
+#   python3 benchmarks/startup.py [--repeat N]
+#
+# run it with and without the ahead-of-time build (python3 setup.py build_ext --inplace) to compare
+#
+import os, sys, argparse, subprocess
+import numpy as np
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+targets = [
+    ('lib.util', 'import lib.util'),
+    ('lib.algos', 'import lib.algos'),
+    ('eval.py', 'import eval'),
+    ('align.py', 'import align'),
+    ('align ground', 'import lib.algos; lib.algos.align_ground_truth'),
+    ('align chroma', 'import lib.algos, librosa'), # what an audio aligner imports before it runs
+]
+
+def startup_time(statement):
+    """ seconds to run statement in a fresh interpreter (measured inside it, excluding interpreter startup) """
+    code = 'import time; t0 = time.perf_counter(); {}; print(time.perf_counter() - t0)'.format(statement)
+    out = subprocess.run([sys.executable, '-c', code], cwd=root, check=True, capture_output=True, text=True)
+    return float(out.stdout.split()[-1])
+
+def modules(statement):
+    """ the heavy third-party modules that statement imports """
+    heavy = ['librosa', 'pretty_midi', 'matplotlib', 'soundfile', 'scipy', 'pyximport', 'Cython']
+    code = 'import sys; {}; print(" ".join(m for m in {} if m in sys.modules))'.format(statement, heavy)
+    out = subprocess.run([sys.executable, '-c', code], cwd=root, check=True, capture_output=True, text=True)
+    return out.stdout.split()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the import time of each entry point')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per entry point (default 5)')
+    opts = parser.parse_args()
+
+    print('{:<16}{:>10}{:>10}  {}'.format('entry point', 'median', 'min', 'heavy imports'))
+    for name,statement in targets:
+        startup_time(statement) # warm the page cache (and compile, if the extensions aren't built)
+        times = [startup_time(statement) for _ in range(opts.repeat)]
+        print('{:<16}{:>9.3f}s{:>9.3f}s  {}'.format(name, np.median(times), np.min(times),
+                                                   ' '.join(modules(statement)) or '-'))
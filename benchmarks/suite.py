@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+#
+# benchmark suite: times each stage of the pipeline on synthetic pieces of increasing size
+# (see synthetic.py), and checks the alignments against the known warp of each piece
+#
+#   python3 benchmarks/suite.py [--sizes 100 200 400] [--output results.json] [--baseline baseline.json]
+#
+# results (seconds, throughput, peak memory and checks of each stage at each size) are written as JSON;
+# with --baseline, stages that got slower than the baseline run by more than --tolerance are flagged as
+# regressions, and the exit status is nonzero if there are regressions, failed checks or stages that
+# raised an error (stages whose optional dependencies aren't installed are reported as skipped)
+#
+import os, sys, json, time, argparse, platform, tempfile, warnings, subprocess, traceback
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import numpy as np
+
+import lib.cache as cache
+import lib.midi as midi
+import lib.util as util
+import lib.algos as algos
+import lib.instrument as instrument
+import synthetic
+
+gtalign = algos.gtalign
+
+#
+# stages: stage(piece, measure) prepares its inputs, calls measure(fn) exactly once to time fn(),
+# and returns the work done (units of the stage) and any checks of the result
+#
+
+stages = {}
+
+def stage(name, unit, max_events=None, audio=False):
+    """ register a stage; it is skipped for pieces with more than max_events chords """
+    def register(f):
+        stages[name] = dict(run=f, unit=unit, max_events=max_events, audio=audio)
+        return f
+    return register
+
+@stage('midi.load_midi', 'notes')
+def _(piece, measure):
+    notes,_ = measure(lambda: midi.load_midi(piece['perf'] + '.midi'))
+    return dict(units=len(notes))
+
+@stage('midi.load_midi_events', 'events')
+def _(piece, measure):
+    events,_,_ = measure(lambda: midi.load_midi_events(piece['perf'] + '.midi'))
+    return dict(units=len(events))
+
+@stage('midi.load_midi_events_packed', 'events')
+def _(piece, measure):
+    pitches,_,_,_ = measure(lambda: midi.load_midi_events_packed(piece['perf'] + '.midi'))
+    return dict(units=len(pitches))
+
+@stage('util.pianoroll', 'frames')
+def _(piece, measure):
+    events,_,_ = midi.load_midi_events(piece['perf'] + '.midi')
+    roll = measure(lambda: util.pianoroll(events))
+    return dict(units=len(roll))
+
+def _ground_truth_inputs(piece, stride=512, fs=44100):
+    score,score_durations,_,_ = midi.load_midi_events_packed(piece['score'])
+    perf_pitches,perf_durations,_,_ = midi.load_midi_events_packed(piece['perf'] + '.midi')
+    return score,score_durations.astype(np.float32),util.pianoroll_packed(perf_pitches, perf_durations, fs, stride),stride/fs
+
+@stage('gtalign.align', 'cells')
+def _(piece, measure):
+    score,timing,perf,ds = _ground_truth_inputs(piece)
+    L,B = measure(lambda: gtalign.align(score, timing, perf, ds, .1, engine='fast', backpointers=True))
+    piece['path'] = gtalign.backtrack(B)
+    return dict(units=len(score)*len(perf), J=len(score), K=len(perf))
+
+@stage('gtalign.align[legacy]', 'cells', max_events=200)
+def _(piece, measure):
+    score,timing,perf,ds = _ground_truth_inputs(piece)
+    L,B = measure(lambda: gtalign.align(score, timing, perf, ds, .1, engine='legacy', backpointers=True))
+    checks = {}
+    if 'path' in piece: checks['same_path_as_fast'] = bool(np.array_equal(gtalign.backtrack(B), piece['path']))
+    return dict(units=len(score)*len(perf), J=len(score), K=len(perf), checks=checks)
+
+@stage('gtalign.traceback', 'events')
+def _(piece, measure):
+    score,timing,perf,ds = _ground_truth_inputs(piece)
+    L = gtalign.align(score, timing, perf, ds, .1, engine='fast')
+    A,_ = measure(lambda: gtalign.traceback(score, timing, perf, L, ds, .1, engine='fast'))
+    checks = {}
+    if 'path' in piece: checks['same_path_as_backtrack'] = bool(np.array_equal([k for _,k in A], piece['path']))
+    return dict(units=len(score), J=len(score), K=len(perf), checks=checks)
+
+def _restricted_path_checks(score, timing, perf, ds, lmbda=.1, **restriction):
+    """
+        checks that every entry point of gtalign, with either engine and with several threads, finds
+        the path of the legacy (brute-force) DP under the same band and/or window
+    """
+    B = gtalign.align(score, timing, perf, ds, lmbda, engine='legacy', backpointers=True, **restriction)[1]
+    reference = gtalign.backtrack(B)
+    same = lambda path: bool(np.array_equal(path, reference))
+
+    checks = dict(backtrack=[], align_backpointers=[], align_path=[], threads=[], traceback=[])
+    for engine in gtalign.engines:
+        L,B = gtalign.align(score, timing, perf, ds, lmbda, engine=engine, backpointers=True, **restriction)
+        checks['backtrack'].append(same(gtalign.backtrack(B)))
+        checks['align_backpointers'].append(same(gtalign.backtrack(gtalign.align_backpointers(
+            score, timing, perf, ds, lmbda, engine=engine, **restriction))))
+        checks['align_path'].append(same(gtalign.align_path(score, timing, perf, ds, lmbda, engine=engine, **restriction)))
+        checks['threads'].append(same(gtalign.align_path(score, timing, perf, ds, lmbda, engine=engine, threads=3,
+                                                         **restriction)))
+        checks['threads'].append(same(gtalign.backtrack(gtalign.align(score, timing, perf, ds, lmbda, engine=engine,
+                                      backpointers=True, threads=3, **restriction)[1])))
+        if 'window' not in restriction: # traceback supports bands, not windows
+            A,_ = gtalign.traceback(score, timing, perf, L, ds, lmbda, engine=engine, band=restriction.get('band'))
+            checks['traceback'].append(same([k for _,k in A]))
+
+    checks = {'{}_same_as_legacy'.format(name): all(results) for name,results in checks.items() if results}
+    return reference, checks
+
+@stage('gtalign.align[band]', 'cells', max_events=200)
+def _(piece, measure):
+    score,timing,perf,ds = _ground_truth_inputs(piece)
+    band = (.5,2.)
+    measure(lambda: gtalign.align(score, timing, perf, ds, .1, band=band, backpointers=True))
+    path,checks = _restricted_path_checks(score, timing, perf, ds, band=band)
+
+    dlo,dhi = gtalign.band_limits(timing, len(perf), ds, band)
+    steps = np.diff(path)
+    checks['path_within_band'] = bool(np.all((steps >= dlo[1:]) & (steps <= dhi[1:])))
+
+    # a band wide enough to never bind finds the unrestricted path
+    unrestricted = gtalign.backtrack(gtalign.align(score, timing, perf, ds, .1, backpointers=True)[1])
+    wide = gtalign.backtrack(gtalign.align(score, timing, perf, ds, .1, band=(.01,100.), backpointers=True)[1])
+    checks['wide_band_same_as_unbanded'] = bool(np.array_equal(wide, unrestricted))
+
+    # align_ground_truth warns when the path touches the edge of a (too narrow) band, and only then
+    def warned(band):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            algos.align_ground_truth(piece['score'], piece['perf'], band=band)
+        return any('touches the tempo band' in str(w.message) for w in caught)
+    checks['narrow_band_warns'] = warned((.95,1.05))
+    checks['wide_band_does_not_warn'] = not warned((.01,100.))
+
+    return dict(units=len(score)*len(perf), J=len(score), K=len(perf), checks=checks)
+
+@stage('gtalign.align[window]', 'cells', max_events=200)
+def _(piece, measure):
+    score,timing,perf,ds = _ground_truth_inputs(piece)
+    unrestricted = gtalign.backtrack(gtalign.align(score, timing, perf, ds, .1, backpointers=True)[1])
+    window = (np.maximum(unrestricted-8, 0).astype(np.int32), np.minimum(unrestricted+8, len(perf)-1).astype(np.int32))
+    measure(lambda: gtalign.align(score, timing, perf, ds, .1, window=window, backpointers=True))
+    path,checks = _restricted_path_checks(score, timing, perf, ds, window=window)
+    checks['path_within_window'] = bool(np.all((path >= window[0]) & (path <= window[1])))
+    # a window around the unrestricted path finds that path
+    checks['same_as_unwindowed'] = bool(np.array_equal(path, unrestricted))
+
+    _,band_checks = _restricted_path_checks(score, timing, perf, ds, band=(.5,2.), window=window)
+    checks.update({'band_and_' + name: ok for name,ok in band_checks.items()})
+
+    return dict(units=len(score)*len(perf), J=len(score), K=len(perf), checks=checks)
+
+def _alignment_checks(piece, alignment, max_error):
+    error = synthetic.warp_error(piece['warp'], alignment)
+    checks = {'mean_error_below_{:g}ms'.format(1000*max_error): bool(np.mean(error) < max_error)}
+    return dict(mean_error_ms=float(1000*np.mean(error)), max_error_ms=float(1000*np.max(error)), checks=checks)
+
+def _aligner(name, function, max_error, max_events=None, audio=True, **kwargs):
+    @stage(name, 'seconds of audio', max_events=max_events, audio=audio)
+    def run(piece, measure):
+        alignment = measure(lambda: function(piece['score'], piece['perf'], **kwargs))
+        return dict(units=piece['seconds'], **_alignment_checks(piece, alignment, max_error))
+
+_aligner('align_ground_truth', algos.align_ground_truth, .025, audio=False)
+_aligner('align_ground_truth[levels=2]', algos.align_ground_truth, .025, audio=False, levels=2)
+_aligner('align_chroma', algos.align_chroma, .1, max_events=800)
+_aligner('align_chroma[multiscale]', algos.align_chroma, .1, dtw='banded', radius=16)
+_aligner('align_spectra', algos.align_spectra, .1, max_events=50) # librosa's DTW is slow on spectra
+_aligner('align_spectra[multiscale]', algos.align_spectra, .1, dtw='banded', radius=16)
+_aligner('align_prettymidi', algos.align_prettymidi, .1, max_events=800)
+
+def _resampled(piece, rate):
+    """ the performance audio of a piece, resampled to rate (returns the path without .wav, like piece['perf']) """
+    import soundfile, soxr
+    perf = '{}-{}'.format(piece['perf'], rate)
+    if not os.path.exists(perf + '.wav'):
+        samples, fs = soundfile.read(piece['perf'] + '.wav', dtype='float32')
+        soundfile.write(perf + '.wav', soxr.resample(samples, fs, rate), rate)
+    return perf
+
+@stage('online.audio_blocks[48kHz]', 'seconds of audio', audio=True)
+def _(piece, measure):
+    import librosa
+    import lib.online as online
+    perf = _resampled(piece, 48000)
+    stream = measure(lambda: np.concatenate(list(online.audio_blocks(perf + '.wav', 44100))))
+    offline,_ = librosa.load(perf + '.wav', sr=44100)
+    checks = dict(length_matches_offline=abs(len(stream) - len(offline)) <= 1, # librosa rounds the length up
+                  samples_match_offline=bool(np.allclose(stream[:len(offline)], offline[:len(stream)], atol=1e-4)))
+    return dict(units=piece['seconds'], checks=checks)
+
+def _online(name, rate=None, max_error=.1):
+    @stage(name, 'seconds of audio', audio=True)
+    def run(piece, measure):
+        perf = piece['perf'] if rate is None else _resampled(piece, rate)
+        alignment,_ = measure(lambda: algos.align_online(piece['score'], perf))
+        return dict(units=piece['seconds'], **_alignment_checks(piece, alignment, max_error))
+
+_online('align_online')
+_online('align_online[48kHz]', rate=48000)
+
+@stage('eval.match_onsets', 'notes')
+def _(piece, measure):
+    import eval
+    score_notes,_ = midi.load_midi(piece['score'])
+    perf_notes,_ = midi.load_midi(piece['perf'] + '.midi')
+    alignment = np.stack(piece['warp'], axis=1)
+    matched = measure(lambda: eval.match_onsets(score_notes, perf_notes, alignment))
+    return dict(units=len(score_notes), checks=dict(all_onsets_matched=len(matched) == len(score_notes)))
+
+#
+# measurement
+#
+
+_failed = set() # stages whose (first) failure or skip has been reported
+
+def run_stage(name, piece, repeat):
+    """ run a stage on a piece: its record, with the best of repeat timings """
+    timings,memory = [],[]
+    def measure(fn):
+        for _ in range(repeat):
+            instrument.reset_peak_rss()
+            before = instrument.rss_mb() # None where /proc isn't available
+            t0 = time.perf_counter()
+            result = fn()
+            timings.append(time.perf_counter() - t0)
+            if before is not None: memory.append(instrument.peak_rss_mb() - before)
+        return result
+
+    record = dict(stage=name, events=piece['events'], unit=stages[name]['unit'])
+    try:
+        record.update(stages[name]['run'](piece, measure))
+    except ImportError as e: # an aligner whose optional dependencies (e.g. pyfluidsynth) aren't installed
+        record['skipped'] = '{}: {}'.format(type(e).__name__, e)
+        if name not in _failed: print('{} skipped: {}'.format(name, e), file=sys.stderr)
+        _failed.add(name)
+        return record
+    except Exception as e:
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+        if name not in _failed: print('{} failed:\n{}'.format(name, traceback.format_exc()), file=sys.stderr)
+        _failed.add(name)
+        return record
+
+    record['seconds'] = min(timings)
+    record['throughput'] = record['units']/record['seconds'] if record['seconds'] > 0 else None
+    if memory: record['peak_mb'] = max(memory)
+    return record
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return dict(python=platform.python_version(), numpy=np.__version__, platform=platform.platform(),
+                cpus=os.cpu_count(), openmp=gtalign.openmp, commit=commit or None)
+
+def scaling(records):
+    """ the empirical scaling exponent of each stage: the slope of log(seconds) against log(events) """
+    exponents = {}
+    for name in stages:
+        points = [(r['events'],r['seconds']) for r in records if r['stage'] == name and r.get('seconds')]
+        if len(points) > 1:
+            x,y = np.log(np.array(points)).T
+            exponents[name] = float(np.polyfit(x, y, 1)[0])
+    return exponents
+
+def compare(records, baseline, tolerance, min_seconds=.005):
+    """ flag records more than tolerance slower than the matching baseline record (and not just noise) """
+    previous = {(r['stage'],r['events']): r for r in baseline['results'] if r.get('seconds')}
+    for record in records:
+        old = previous.get((record['stage'],record['events']))
+        if old is None or not record.get('seconds'): continue
+        record['baseline_seconds'] = old['seconds']
+        record['regression'] = (record['seconds'] > (1+tolerance)*old['seconds']
+                                and record['seconds'] - old['seconds'] > min_seconds)
+
+def report(records, exponents):
+    print('{:<30}{:>7}{:>11}{:>16}{:>10}{:>10}  {}'.format('stage', 'events', 'seconds', 'throughput/s', 'peak MB',
+                                                         'baseline', 'checks'))
+    for r in records:
+        if 'error' in r or 'skipped' in r:
+            print('{:<30}{:>7}  {}'.format(r['stage'], r['events'],
+                                           'FAILED ' + r['error'] if 'error' in r else 'skipped ' + r['skipped']))
+            continue
+        checks = ' '.join('{}={}'.format(k, 'ok' if v else 'FAILED') for k,v in r.get('checks', {}).items())
+        if 'mean_error_ms' in r: checks = 'error {:.1f}ms '.format(r['mean_error_ms']) + checks
+        baseline = ''
+        if 'baseline_seconds' in r:
+            baseline = '{:+.0f}%'.format(100*(r['seconds']/r['baseline_seconds'] - 1)) + (' !' if r['regression'] else '')
+        print('{:<30}{:>7}{:>11.4f}{:>16.4g}{:>10}{:>10}  {}'.format(r['stage'], r['events'], r['seconds'],
+              r['throughput'] or 0, '{:.0f}'.format(r['peak_mb']) if 'peak_mb' in r else '-', baseline, checks))
+
+    if exponents:
+        print('\nscaling exponents (seconds ~ events^x):')
+        for name,x in exponents.items(): print('   {:<30}{:.2f}'.format(name, x))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the alignment pipeline on synthetic pieces')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100,200,400], help='chords per piece (default 100 200 400)')
+    parser.add_argument('--polyphony', type=int, default=3, help='maximum notes per chord (default 3)')
+    parser.add_argument('--tempo-variance', type=float, default=.1, help='variance of the log-tempo (default 0.1)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='timings per stage (the best is reported; default 3)')
+    parser.add_argument('--stages', nargs='+', metavar='STAGE', help='run only these stages (default: all)')
+    parser.add_argument('--no-audio', action='store_true', help="skip the audio aligners (and don't synthesize audio)")
+    parser.add_argument('--output', metavar='FILE', help='write the results to FILE (JSON)')
+    parser.add_argument('--baseline', metavar='FILE', help='compare with the results of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=.25,
+                        help='slowdown relative to the baseline flagged as a regression (default 0.25)')
+    opts = parser.parse_args()
+
+    selected = opts.stages or list(stages)
+    unknown = set(selected) - set(stages)
+    if unknown: parser.error('unknown stages: {} (choose from {})'.format(', '.join(sorted(unknown)), ', '.join(stages)))
+    if opts.no_audio: selected = [name for name in selected if not stages[name]['audio']]
+
+    cache.configure(None) # time the computations, not cache lookups
+    records = []
+    with tempfile.TemporaryDirectory() as directory:
+        for events in opts.sizes:
+            piece = synthetic.generate(directory, 'piece{}'.format(events), events, opts.polyphony,
+                                       opts.tempo_variance, seed=opts.seed,
+                                       audio=any(stages[name]['audio'] for name in selected))
+            for name in selected:
+                if stages[name]['max_events'] is not None and events > stages[name]['max_events']: continue
+                records.append(run_stage(name, piece, opts.repeat))
+
+    exponents = scaling(records)
+    if opts.baseline is not None:
+        with open(opts.baseline) as f: compare(records, json.load(f), opts.tolerance)
+    report(records, exponents)
+
+    results = dict(environment=environment(), params=dict(polyphony=opts.polyphony, tempo_variance=opts.tempo_variance,
+                   seed=opts.seed, repeat=opts.repeat), results=records, scaling=exponents)
+    if opts.output is not None:
+        with open(opts.output, 'w') as f: json.dump(results, f, indent=1)
+
+    regressions = [r for r in records if r.get('regression')]
+    failures = [r for r in records if 'error' in r or not all(r.get('checks', {}).values())]
+    skipped = sorted({r['stage'] for r in records if 'skipped' in r})
+    if regressions: print('\n{} regression(s) relative to {}'.format(len(regressions), opts.baseline))
+    if failures: print('\n{} failed stage(s) or check(s)'.format(len(failures)))
+    if skipped: print('\nskipped (missing optional dependencies): {}'.format(', '.join(skipped)))
+    sys.exit(1 if regressions or failures else 0)
@@ -0,0 +1,70 @@
+#
+# synthetic benchmark data: a random score and a tempo-warped "performance" of it
+#
+# the score is a sequence of chords (no pitch is repeated between consecutive chords, so every note
+# ends exactly when the next chord starts); the performance plays the same notes with the duration of
+# each chord stretched by a smoothly varying tempo, so the true alignment (warp) is known exactly.
+# Times are quantized to the MIDI tick grid used by midi.write_midi, so nothing is lost writing them
+#
+import os
+import numpy as np
+
+import lib.midi as midi
+
+ticks_per_beat = 960
+tick = .5/ticks_per_beat # seconds per tick (write_midi writes at 120bpm)
+
+def generate(directory, name='piece', events=200, polyphony=3, tempo_variance=.1, fs=44100, seed=0, audio=True):
+    """
+        write a synthetic score (directory/name-score.midi) and performance (directory/name-perf.midi
+        and, if audio, directory/name-perf.wav synthesized with pretty_midi's sine synthesizer)
+
+        events is the number of chords, polyphony the maximum number of notes in a chord, and
+        tempo_variance the variance of the log-tempo of the performance (0 plays the score as written)
+
+        returns a dict with the paths (score, perf, as passed to the aligners in lib/algos.py) and
+        the true warp: (score_times, perf_times), the times of the chord boundaries in each
+    """
+    rng = np.random.default_rng(seed)
+
+    # chord durations of an eighth, quarter or half note at 120bpm
+    durations = rng.choice([.25,.5,1.], size=events)
+    score_times = np.concatenate(([0],np.cumsum(durations)))
+
+    # the log-tempo is an AR(1) process, so the tempo drifts rather than jumping from chord to chord
+    a = .9
+    log_tempo = np.zeros(events)
+    noise = rng.standard_normal(events)*np.sqrt(tempo_variance*(1-a**2))
+    log_tempo[0] = noise[0]/np.sqrt(1-a**2)
+    for j in range(1,events): log_tempo[j] = a*log_tempo[j-1] + noise[j]
+    ticks = np.maximum(1, np.round(durations*np.exp(-log_tempo)/tick)).astype(np.int64)
+    perf_times = np.concatenate(([0],np.cumsum(ticks)))*tick
+
+    chords,previous = [],set()
+    for j in range(events):
+        candidates = [p for p in range(36,96) if p not in previous]
+        chord = rng.choice(candidates, size=rng.integers(1,polyphony+1), replace=False).tolist()
+        chords.append(chord)
+        previous = set(chord)
+
+    def notes(times):
+        return sorted([(pitch,times[j],times[j+1]) for j,chord in enumerate(chords) for pitch in chord],
+                      key=lambda n: (n[1],n[0]))
+
+    os.makedirs(directory, exist_ok=True)
+    score = os.path.join(directory, name + '-score.midi')
+    perf = os.path.join(directory, name + '-perf')
+    midi.write_midi(score, notes(score_times.tolist()), ticks_per_beat)
+    midi.write_midi(perf + '.midi', notes(perf_times.tolist()), ticks_per_beat)
+    if audio:
+        import pretty_midi, soundfile
+        samples = pretty_midi.PrettyMIDI(perf + '.midi').synthesize(fs=fs)
+        soundfile.write(perf + '.wav', samples/max(1e-9,np.max(np.abs(samples))), fs)
+
+    return dict(score=score, perf=perf, warp=(score_times,perf_times), events=events,
+                notes=sum(len(chord) for chord in chords), seconds=float(perf_times[-1]))
+
+def warp_error(warp, alignment):
+    """ absolute error (seconds) of each (score time, performance time) pair of an alignment under the true warp """
+    alignment = np.asarray(alignment, dtype=np.float64).reshape(-1,2)
+    return np.abs(alignment[:,1] - np.interp(alignment[:,0], *warp))
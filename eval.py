@@ -1,110 +1,235 @@
-import os, sys
+import os, csv, json, argparse, contextlib, multiprocessing
 import numpy as np
 
 import lib.util as util
 import lib.midi as midi
+import lib.cache as cache
+import lib.store as store
+import lib.instrument as instrument
 
 def match_onsets(score_notes, perf_notes, gt_alignment, thres=.100):
-    """ Onset matching heuristic """
+    """
+        Onset matching heuristic
+
+        matches each score note to the nearest performance onset of the same pitch within thres of the
+        score onset's ground-truth time (ties go to the performance note listed first)
+    """
 
-    matched_onsets = []
     pitches,score_onsets,score_offsets = zip(*score_notes)
     gt_onsets = np.interp(score_onsets,*zip(*gt_alignment))
-    for pitch,gt_onset,score_onset in zip(pitches,gt_onsets,score_onsets):
-        best_dist = 1 + thres
-        for perf_pitch, perf_onset, _ in perf_notes:
-            if np.abs(perf_onset - gt_onset) > thres:
-                 continue # not a match (too far away)
-            if perf_pitch != pitch:
-                 continue # not a match (wrong pitch)
-
-            dist = np.abs(perf_onset - gt_onset)
-            if dist < thres and dist < best_dist: # found a possible match
-                best_match = perf_onset
-                best_dist = dist
-
-        if best_dist < thres: # found a match
-            matched_onsets.append((score_onset,best_match))
-            
-    return matched_onsets
-
-def evaluate(candidatedir, gtdir, scoredir, perfdir):
-    mad, old_mad, rmse, old_rmse, missedpct = [[] for _ in range(5)]
-    outliers = 0
+    pitches,score_onsets = np.asarray(pitches),np.asarray(score_onsets)
+    perf_pitches,perf_onsets,_ = [np.asarray(v) for v in zip(*perf_notes)] if perf_notes else [np.zeros(0)]*3
+
+    best_match = np.zeros(len(gt_onsets))
+    best_dist = np.full(len(gt_onsets), np.inf)
+    for pitch in np.unique(pitches):
+        candidates = np.flatnonzero(perf_pitches == pitch)
+        if len(candidates) == 0: continue # not a match (wrong pitch)
+
+        # performance onsets of this pitch, sorted (stably, so equal onsets stay in listed order)
+        candidates = candidates[np.argsort(perf_onsets[candidates], kind='stable')]
+        onsets = perf_onsets[candidates]
+
+        # the nearest onsets are the last one before gt_onset and the first one at or after it
+        notes = np.flatnonzero(pitches == pitch)
+        gt = gt_onsets[notes]
+        right = np.searchsorted(onsets, gt)
+        left = np.searchsorted(onsets, onsets[np.maximum(right-1, 0)]) # first of any equal onsets
+        left_dist = np.where(right > 0, np.abs(onsets[left] - gt), np.inf)
+        right_dist = np.where(right < len(onsets), np.abs(onsets[np.minimum(right, len(onsets)-1)] - gt), np.inf)
+
+        first = candidates[left] < candidates[np.minimum(right, len(onsets)-1)]
+        use_right = (right_dist < left_dist) | ((right_dist == left_dist) & ~first)
+        best_dist[notes] = np.where(use_right, right_dist, left_dist)
+        best_match[notes] = onsets[np.where(use_right, np.minimum(right, len(onsets)-1), left)]
+
+    found = best_dist < thres # found a match
+    return list(zip(score_onsets[found].tolist(), best_match[found].tolist()))
+
+def metrics(gt_alignment, ch_alignment):
+    """
+        time error (MAD) and deviation (RMSE) of the piecewise-linear error between two alignments
+        sampled at the same score times
+    """
+    S = gt_alignment[-1,0] - gt_alignment[0,0]
+    ds = gt_alignment[1:,0] - gt_alignment[:-1,0]
+    error = gt_alignment[:,1] - ch_alignment[:,1]
+
+    # integrals of |error| and error^2 over each segment (error is linear on each segment)
+    e1,e2 = np.abs(error[:-1]),np.abs(error[1:])
+    samesign = np.sign(error[:-1])==np.sign(error[1:])
+    with np.errstate(divide='ignore', invalid='ignore'): # e1+e2 == 0 only if samesign
+        dev = np.where(samesign, (1/2)*(e1+e2), (1/2)*(e1**2+e2**2)/(e1+e2))
+
+    e1,e2 = error[:-1],error[1:]
+    se = (1/3)*(e1**2+e1*e2+e2**2)
+
+    return (1./S)*np.dot(dev,ds), np.sqrt((1./S)*np.dot(se,ds))
+
+def evaluate_performance(file, candidatedir, gtdir, perfdir, score):
+    """ metrics for one performance; score is (score_start, score_end, score_notes) as returned by load_score """
     epsilon = 1e-4
-    print("Performance\tTimeErr\tTimeDev\tNoteErr\tNoteDev\t%Match")
-    for file in sorted([f[:-len('.midi')] for f in os.listdir(perfdir) if f.endswith('.midi')]):
-        gt_alignment = np.loadtxt(os.path.join(gtdir, file + '.txt'))
-        ch_alignment = np.loadtxt(os.path.join(candidatedir, file + '.txt'))
-    
-        score_file = os.path.join(scoredir, util.map_score(file) + '.midi')
-        _,score_start,score_end = midi.load_midi_events(score_file, strip_ends=True)
-    
-        # truncate to the range [score_start,score_end)
-        idx0 = np.argmin(score_start > gt_alignment[:,0])
-        idxS = np.argmin(score_end > gt_alignment[:,0] + epsilon)
-        gt_alignment = gt_alignment[idx0:idxS]
-    
-        #
-        # compute our metrics
-        #
-    
+    score_start,score_end,score_notes = score
+    with instrument.stage('load alignments'):
+        gt_alignment = store.load_alignment(gtdir, file)
+        ch_alignment = store.load_alignment(candidatedir, file)
+
+    # truncate to the range [score_start,score_end)
+    idx0 = np.argmin(score_start > gt_alignment[:,0])
+    idxS = np.argmin(score_end > gt_alignment[:,0] + epsilon)
+    gt_alignment = gt_alignment[idx0:idxS]
+
+    #
+    # compute our metrics
+    #
+
+    with instrument.stage('metrics'):
         # linearized timings
         linearized = np.interp(gt_alignment[:,0],*zip(*ch_alignment))
         ch_alignment = gt_alignment.copy()
         ch_alignment[:,1] = linearized
-    
-        S = gt_alignment[-1,0] - gt_alignment[0,0]
-        ds = gt_alignment[1:,0] - gt_alignment[:-1,0]
-        error = list(gt_alignment[0:,1] - ch_alignment[0:,1])
-
-        dev = [(1/2)*(e1+e2) if samesign
-            else (1/2)*(e1**2+e2**2)/(e1+e2)
-            for (e1,e2,samesign) in zip(np.abs(error[:-1]),np.abs(error[1:]),np.sign(error[:-1])==np.sign(error[1:]))]
-
-        se = [(1/3)*(e1**2+e1*e2+e2**2) for (e1,e2) in zip(error[:-1],error[1:])]
-
-        thismad = (1./S)*np.dot(dev,ds)
-        thisrmse = np.sqrt((1./S)*np.dot(se,ds))
-    
-        #
-        # compute old metrics
-        #
-    
-        score_notes,_ = midi.load_midi(os.path.join(scoredir, util.map_score(file) + '.midi'))
-        perf_notes,_ = midi.load_midi(os.path.join(perfdir,file + '.midi'))
+
+        mad,rmse = metrics(gt_alignment, ch_alignment)
+
+    #
+    # compute old metrics
+    #
+
+    perf_notes,_ = midi.load_midi(os.path.join(perfdir,file + '.midi'))
+    with instrument.stage('match onsets'):
         matched_onsets = match_onsets(score_notes, perf_notes, gt_alignment)
-        missedpct.append(100*len(matched_onsets)/len(score_notes))
+    matchpct = 100*len(matched_onsets)/len(score_notes)
+
+    onsets, gt_onsets = zip(*matched_onsets)
+    ch_aligned_onsets = np.interp(onsets,*zip(*ch_alignment))
+    dev = gt_onsets - ch_aligned_onsets
+
+    old_mad = (1./len(dev))*np.sum(np.abs(dev))
+    old_rmse = np.sqrt((1./len(dev))*np.sum(np.power(dev,2)))
+
+    record = dict(candidate=candidatedir, performance=file, mad=float(mad), rmse=float(rmse),
+                  old_mad=float(old_mad), old_rmse=float(old_rmse), matchpct=matchpct)
 
-        onsets, gt_onsets = zip(*matched_onsets)
-        ch_aligned_onsets = np.interp(onsets,*zip(*ch_alignment))
-        dev = gt_onsets - ch_aligned_onsets
+    # processing latency of each block of audio, for online algorithms
+    entry = store.index(candidatedir).get(file)
+    if entry is not None and 'latency' in entry['arrays']:
+        latency = 1000*store.load(candidatedir, entry, 'latency')
+        record.update(blocks=len(latency), latency_mean_ms=float(np.mean(latency)),
+                      latency_p95_ms=float(np.percentile(latency, 95)), latency_max_ms=float(np.max(latency)))
 
-        thisold_mad = (1./len(dev))*np.sum(np.abs(dev))
-        thisold_rmse = np.sqrt((1./len(dev))*np.sum(np.power(dev,2)))
+    return record
 
-        # throw out outliers with error > 300ms
-        if thismad < .300:
-            mad.append(thismad)
-            rmse.append(thisrmse)
-            old_mad.append(thisold_mad)
-            old_rmse.append(thisold_rmse)
+def load_score(score_file):
+    """ the parts of a score used for evaluation: (score_start, score_end, score_notes) """
+    _,score_start,score_end = midi.load_midi_events(score_file, strip_ends=True)
+    score_notes,_ = midi.load_midi(score_file)
+
+    return score_start,score_end,score_notes
+
+def write_records(filename, records):
+    """ write per-performance records as CSV (.csv) or JSON lines (anything else) """
+    with open(filename, 'w', newline='') as f:
+        if filename.endswith('.csv'):
+            writer = csv.DictWriter(f, fieldnames=list(dict.fromkeys(k for record in records for k in record)))
+            writer.writeheader()
+            writer.writerows(records)
         else:
-            outliers += 1   
+            for record in records: f.write(json.dumps(record) + '\n')
+
+def _evaluate_performance(args):
+    with instrument.job(args[0]) as measured:
+        record = evaluate_performance(*args)
+    return record, measured
+
+def _configure_worker(cache_root, cache_size_gb, midi_cached, instrumented):
+    """ pool initializer: the cache and instrumentation settings of the main process, which workers started by spawn don't inherit """
+    cache.configure(cache_root, cache_size_gb)
+    midi.configure(midi_cached)
+    instrument.configure(instrumented)
+
+def evaluate(candidatedir, gtdir, scoredir, perfdir, parallel=0, records=None, instrument_log=None):
+    """
+        evaluate every performance in perfdir, printing a table of results (and the bottom line)
+
+        parallel > 0 spreads performances over that many processes
+        records (optional) is a .csv or .jsonl file to write the per-performance results to
+        instrument_log (optional) is a JSON lines file to append the time spent in each stage of each
+        evaluation to (see lib/instrument.py); a summary is printed at the end
+
+        returns the per-performance results as a list of dicts
+    """
+    mad, old_mad, rmse, old_rmse, missedpct = [[] for _ in range(5)]
+    outliers = 0
+    if instrument_log is not None: instrument.configure(True)
+    performances = sorted([f[:-len('.midi')] for f in os.listdir(perfdir) if f.endswith('.midi')])
 
-        print('{}\t{:.4f}\t{:.4f}\t{:.4f}\t{:.4f}\t{:.4f}'.format(file, thismad, thisrmse, thisold_mad, thisold_rmse, missedpct[-1]))
+    # parse each score once (several performances share a score)
+    scores = {}
+    for file in performances:
+        score_file = os.path.join(scoredir, util.map_score(file) + '.midi')
+        if score_file not in scores: scores[score_file] = load_score(score_file)
+    jobs = [(file, candidatedir, gtdir, perfdir, scores[os.path.join(scoredir, util.map_score(file) + '.midi')])
+            for file in performances]
+
+    print("Performance\tTimeErr\tTimeDev\tNoteErr\tNoteDev\t%Match")
+    results,measurements = [],[]
+    with contextlib.ExitStack() as stack:
+        if parallel > 0:
+            pool = stack.enter_context(multiprocessing.Pool(parallel, _configure_worker,
+                                                            (cache.root, cache.max_bytes/2**30, midi.cached, instrument.enabled)))
+            evaluated = pool.imap(_evaluate_performance, jobs)
+        else:
+            evaluated = map(_evaluate_performance, jobs)
+
+        for result,measured in evaluated:
+            if instrument_log is not None:
+                instrument.write(instrument_log, measured, candidate=candidatedir)
+                measurements.append(measured)
+
+            # throw out outliers with error > 300ms
+            result['outlier'] = result['mad'] >= .300
+            if not result['outlier']:
+                mad.append(result['mad'])
+                rmse.append(result['rmse'])
+                old_mad.append(result['old_mad'])
+                old_rmse.append(result['old_rmse'])
+            else:
+                outliers += 1
+            missedpct.append(result['matchpct'])
+            results.append(result)
+
+            print('{}\t{:.4f}\t{:.4f}\t{:.4f}\t{:.4f}\t{:.4f}'.format(result['performance'], result['mad'], result['rmse'], result['old_mad'], result['old_rmse'], result['matchpct']))
 
     print('=' * 100)
     print('{}\t{:.4f}\t{:.4f}\t{:.4f}\t{:.4f}\t{:.4f}'.format('bottomline', np.mean(mad), np.mean(rmse), np.mean(old_mad), np.mean(old_rmse), np.mean(missedpct)))
     print('(removed {} outliers)'.format(outliers))
-   
 
-if __name__ == "__main__":
-    algo = sys.argv[1]
-    scoredir = sys.argv[2]
-    perfdir = sys.argv[3]
+    online = [result for result in results if 'blocks' in result]
+    if online:
+        blocks = sum(result['blocks'] for result in online)
+        print('Latency per block: mean {:.2f}ms, worst 95th percentile {:.2f}ms, max {:.2f}ms ({} blocks)'.format(
+            sum(result['latency_mean_ms']*result['blocks'] for result in online)/blocks,
+            max(result['latency_p95_ms'] for result in online), max(result['latency_max_ms'] for result in online), blocks))
 
-    candidatedir = os.path.join('align',algo)
-    gtdir = os.path.join('align','ground')
-    evaluate(candidatedir, gtdir, scoredir, perfdir)
+    if records is not None: write_records(records, results)
+    if measurements: instrument.report(measurements)
+    return results
 
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Evaluate the alignments computed by an algorithm against the ground truth')
+    parser.add_argument('algo', help='algorithm (alignments are read from align/ALGO)')
+    parser.add_argument('scoredir')
+    parser.add_argument('perfdir')
+    parser.add_argument('--candidatedir', help='read candidate alignments from here instead of align/ALGO')
+    parser.add_argument('--parallel', type=int, default=0, help='number of parallel processes (default 0: non-parallel)')
+    parser.add_argument('--records', metavar='FILE', help='write per-performance results to FILE (.csv or .jsonl)')
+    parser.add_argument('--instrument', metavar='FILE', help='append the time spent in each stage of each evaluation to FILE (JSON lines)')
+    parser.add_argument('--no-cache', action='store_true', help='parse the MIDI files from scratch (and don\'t cache the parses)')
+    opts = parser.parse_args()
+
+    midi.configure(not opts.no_cache)
+
+    candidatedir = opts.candidatedir if opts.candidatedir is not None else os.path.join('align',opts.algo)
+    gtdir = os.path.join('align','ground')
+    evaluate(candidatedir, gtdir, opts.scoredir, opts.perfdir, opts.parallel, opts.records, opts.instrument)
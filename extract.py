@@ -1,6 +1,7 @@
 #!/usr/bin/python3
-import os,sys,errno,csv,re
+import os,csv,re,argparse,subprocess,contextlib,multiprocessing
 import lib.midi as midilib
+import lib.cache as cache
 import lib.util as util
 
 from scipy.io import wavfile
@@ -45,57 +46,133 @@ partial = {
     '2011/MIDI-Unprocessed_05_R1_2011_MID--AUDIO_R1-D2_09_Track09_wav.midi' : 'f', # just the fugue
 }
 
-def extract(basename, score_root, data, notes, ticks_per_beat):
-    scorename = util.map_score(basename)
-    print('Writing {} (associated score {})'.format(basename, scorename))
-    midilib.write_midi(basename + '.midi', notes, ticks_per_beat)
-    wavfile.write(basename + '.wav', fs, data)
-    score = os.path.join(score_root, scorename + '.krn')
-    target = 'data/score/{}'.format(scorename + '.midi')
-    os.system('hum2mid {} -o {}'.format(score, target))
+def outputs(root, rows):
+    """
+        the performances to extract from the index of the MAESTRO dataset at root, numbered in index order
+
+        returns a list of (midi, wav, parts): the source files of a recording and its (basename, start, end)
+        parts, the time range [start,end) in seconds of each (end None for the end of the recording)
+    """
+    wtc = re.compile('Prelude and F')
+    bwv = re.compile('BWV (\d*)')
+
+    oneup = 0
+    recordings = []
+    for row in rows:
+        if row[0] != 'Johann Sebastian Bach': continue # not bach
+        if not wtc.search(row[1]): continue # not wtc
+        if row[4] in exclude: continue # something wrong with these
+
+        identifier = bwv.search(row[1])
+        if identifier:
+            outfile = 'bwv{}'.format(identifier.group(1))
+        else:
+            try:
+                outfile = 'bwv{}'.format(hardcoded_bwvs[row[1]])
+            except KeyError:
+                print('MISSING:', row[1])
+
+        if row[4] in partial: #special cases
+            parts = [('data/perf/{:03d}_{}{}'.format(oneup, outfile, partial[row[4]]), 0, None)]
+        else: # split into prelude and fugue (at a time found by extract_recording)
+            parts = [('data/perf/{:03d}_{}{}'.format(oneup + i, outfile, part), None, None) for i,part in enumerate('pf')]
+        oneup += len(parts)
+
+        recordings.append((os.path.join(root,row[4]), os.path.join(root,row[5]), parts))
+
+    return recordings
+
+def up_to_date(basename, fs, frames):
+    """ whether a performance was already extracted: both files exist and the audio has the expected length """
+    if not os.path.exists(basename + '.midi'): return False
+    try:
+        rate,data = wavfile.read(basename + '.wav', mmap=True)
+    except (OSError, ValueError):
+        return False
+
+    return rate == fs and len(data) == frames
+
+def configure_worker(cache_root, cache_size_gb, midi_cached):
+    """ pool initializer: the cache settings of the main process, which workers started by spawn don't inherit """
+    cache.configure(cache_root, cache_size_gb)
+    midilib.configure(midi_cached)
+
+def extract_recording(recording):
+    """ write the parts of one recording, skipping those already extracted; returns the number written """
+    midi, wav, parts = recording
+    notes, ticks_per_beat = midilib.load_midi(midi)
+    fs, data = wavfile.read(wav, mmap=True) # memory-mapped: slices are written straight from the source
+
+    if len(parts) > 1:
+        splitpoint = midilib.split(notes)
+        parts = [(parts[0][0], 0, splitpoint), (parts[1][0], splitpoint, None)]
+
+    written = 0
+    for basename,start,end in parts:
+        a,b = int(fs*start),len(data) if end is None else int(fs*end)
+        if up_to_date(basename, fs, b-a):
+            continue
+
+        part_notes = [(n[0],n[1]-start,n[2]-start) for n in notes if n[1] >= start and (end is None or n[1] < end)]
+        print('Writing {} (associated score {})'.format(basename, util.map_score(basename)))
+        _atomic_write(basename + '.midi', lambda f: midilib.write_midi(f, part_notes, ticks_per_beat))
+        _atomic_write(basename + '.wav', lambda f: wavfile.write(f, fs, data[a:b]))
+        written += 1
+
+    return written
+
+def convert_score(args):
+    """ convert a kern score to midi with hum2mid (unless it was already converted) """
+    score, target = args
+    if os.path.exists(target) and os.path.getsize(target) > 0: return 0
+
+    _atomic_write(target, lambda f: subprocess.run(['hum2mid', score, '-o', f], check=True))
+    return 1
+
+def _atomic_write(path, write):
+    """ write(tmp) to a temporary file, then move it to path, so that no partial output is ever left behind """
+    name,ext = os.path.splitext(path)
+    tmp = '{}.{}.tmp{}'.format(name, os.getpid(), ext) # each output is written by one process
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Extract the alignment dataset from the WTC kern scores and MAESTRO')
+    parser.add_argument('scores', help='the bach-wtc kern scores')
+    parser.add_argument('maestro', help='the MAESTRO dataset (v2.0.0)')
+    parser.add_argument('--parallel', type=int, default=0, help='number of parallel processes (default 0: non-parallel)')
+    parser.add_argument('--no-cache', action='store_true', help='parse the MIDI files from scratch (and don\'t cache the parses)')
+    opts = parser.parse_args()
+
+    midilib.configure(not opts.no_cache)
+
     os.makedirs('data/perf',exist_ok=True)
     os.makedirs('data/score',exist_ok=True)
 
-    oneup = 0
-    score_root = os.path.join(sys.argv[1],'kern')
-    root = sys.argv[2]
+    score_root = os.path.join(opts.scores,'kern')
+    root = opts.maestro
     with open(os.path.join(root,'maestro-v2.0.0.csv')) as f:
-        index = csv.reader(f)
-
-        wtc = re.compile('Prelude and F')
-        bwv = re.compile('BWV (\d*)')
-        for row in index:
-            if row[0] != 'Johann Sebastian Bach': continue # not bach
-            if not wtc.search(row[1]): continue # not wtc
-            if row[4] in exclude: continue # something wrong with these
-        
-            identifier = bwv.search(row[1])
-            if identifier:
-                outfile = 'bwv{}'.format(identifier.group(1))
-            else:
-                try:
-                    outfile = 'bwv{}'.format(hardcoded_bwvs[row[1]])
-                except KeyError:
-                    print('MISSING:', row[1])
-
-            notes, ticks_per_beat = midilib.load_midi(os.path.join(root,row[4]))
-            fs, data = wavfile.read(os.path.join(root,row[5]))
-
-            if row[4] in partial: #special cases
-                basename = 'data/perf/{:03d}_{}{}'.format(oneup, outfile, partial[row[4]])
-                extract(basename, score_root, data, notes, ticks_per_beat)
-                oneup += 1
-            else:
-                splitpoint = midilib.split(notes)
-                pnotes = [n for n in notes if n[1] < splitpoint]
-                basename = 'data/perf/{:03d}_{}{}'.format(oneup, outfile, 'p')
-                extract(basename, score_root, data[:int(fs*splitpoint)], pnotes, ticks_per_beat)
-                oneup += 1
-                fnotes = [(n[0],n[1]-splitpoint,n[2]-splitpoint) for n in notes if n[1] >= splitpoint]
-                basename = 'data/perf/{:03d}_{}{}'.format(oneup, outfile, 'f')
-                extract(basename, score_root, data[int(fs*splitpoint):], fnotes, ticks_per_beat)
-                oneup += 1
+        recordings = outputs(root, csv.reader(f))
+
+    # many performances share a score: convert each score once
+    scorenames = sorted({util.map_score(basename) for _,_,parts in recordings for basename,_,_ in parts})
+    scores = [(os.path.join(score_root, name + '.krn'), 'data/score/{}'.format(name + '.midi')) for name in scorenames]
+
+    with contextlib.ExitStack() as stack:
+        if opts.parallel > 0:
+            pool = stack.enter_context(multiprocessing.Pool(opts.parallel, configure_worker,
+                                                            (cache.root, cache.max_bytes/2**30, midilib.cached)))
+            imap = pool.imap_unordered
+        else:
+            imap = map
+
+        converted = sum(imap(convert_score, scores))
+        written = sum(imap(extract_recording, recordings))
 
+    performances = sum(len(parts) for _,_,parts in recordings)
+    print('Converted {} of {} scores, wrote {} of {} performances (the rest were up to date)'.format(
+        converted, len(scores), written, performances))
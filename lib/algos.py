@@ -1,58 +1,257 @@
-import sys
+import os, sys, time, warnings, contextlib
 import numpy as np
-import librosa, pretty_midi
 import lib.midi as midi
 import lib.util as util
+import lib.cache as cache
+import lib.instrument as instrument
 
-import pyximport
-pyximport.install(reload_support=True, language_level=sys.version_info[0],
-                  setup_args={"include_dirs":np.get_include()})
-import lib.gtalign as gtalign
+# librosa, pretty_midi, soundfile and the audio feature modules are imported by the aligners that use them,
+# so ground-truth runs (and their worker processes) don't pay for importing them
 
-def align_ground_truth(score_midi, perf, fs=44100, stride=512, lmbda=0.1):
-    score_events,score_start,score_end = midi.load_midi_events(score_midi)
-    perf_events,perf_start,perf_end = midi.load_midi_events(perf + '.midi')
+try: # the extensions built ahead of time by setup.py (python3 setup.py build_ext --inplace)
+    import lib.gtalign as gtalign
+    import lib.dtw as dtwlib
+    for _module in (gtalign, dtwlib):
+        _source = os.path.join(os.path.dirname(_module.__file__), _module.__name__.split('.')[-1] + '.pyx')
+        if os.path.getmtime(_module.__file__) < os.path.getmtime(_source):
+            warnings.warn('{} is older than {}; rebuild it with setup.py'.format(_module.__file__, _source))
+except ImportError: # otherwise compile them on first import
+    import pyximport
+    pyximport.install(reload_support=True, language_level=sys.version_info[0],
+                      setup_args={"include_dirs":np.get_include()})
+    import lib.gtalign as gtalign
+    import lib.dtw as dtwlib
 
-    score_rep = score_events.astype(np.float32)
-    perf_rep = util.pianoroll(perf_events).astype(np.float32)
+dtw_engines = ('librosa', 'banded')
+
+# the version of the score synthesis, part of the key of the cached synthesized audio and of the score
+# features computed from it: bump it when _synthesize changes what it returns (version 2 keeps fluidsynth's
+# float64 samples rather than casting them to float32)
+synth_version = 2
+
+def align_ground_truth(score_midi, perf, fs=44100, stride=512, lmbda=0.1, engine='fast', band=None,
+                       max_memory=None, threads=1, levels=0, factor=4, radius=32):
+    """
+        levels > 0 aligns coarse-to-fine: first at stride*factor**levels (with score events merged
+        to match), then at each finer level only within radius frames of the projected coarser path
+    """
+    return align_ground_truth_batch(score_midi, [perf], fs, stride, lmbda, engine, band, max_memory,
+                                    threads, levels, factor, radius)[0]
+
+def align_ground_truth_batch(score_midi, perfs, fs=44100, stride=512, lmbda=0.1, engine='fast', band=None,
+                             max_memory=None, threads=1, levels=0, factor=4, radius=32):
+    """ align_ground_truth of several performances of the same score, which is loaded once; returns a list """
+    with instrument.stage('load midi'):
+        score = midi.load_midi_events_packed(score_midi)
+    instrument.record(J=len(score[0]))
+    return [_align_ground_truth(score, perf, fs, stride, lmbda, engine, band, max_memory, threads, levels, factor, radius)
+            for perf in perfs]
+
+def _align_ground_truth(score, perf, fs, stride, lmbda, engine, band, max_memory, threads, levels, factor, radius):
+    score_pitches,score_durations,score_start,score_end = score
+    with instrument.stage('load midi'):
+        perf_pitches,perf_durations,perf_start,perf_end = midi.load_midi_events_packed(perf + '.midi')
+
+    score_timing = score_durations.astype(np.float32)
+    with instrument.stage('pianoroll'):
+        perf_rep = util.pianoroll_packed(perf_pitches, perf_durations, fs, stride)
+    instrument.record(K=len(perf_rep))
 
     ds = stride/fs
-    L = gtalign.align(score_rep,perf_rep,ds,lmbda)
-    path,_ = gtalign.traceback(score_rep,perf_rep,L,ds,lmbda)
+    path,window,touches,refined = None,None,0,0
+    for f in [factor**l for l in range(levels,0,-1)] + [1]: # coarse to fine
+        if f > 1:
+            # a coarse frame spans f frames; merge score events that last less than that (at the average tempo)
+            pitches,timing = _merge_events(score_pitches, score_durations, f*np.sum(score_durations)/len(perf_rep))
+            timing,roll = timing.astype(np.float32),_merge_frames(perf_rep, f)
+        else:
+            pitches,timing,roll = score_pitches,score_timing,perf_rep
+
+        if path is not None:
+            window = _corridor(path, prev_timing, prev_ds, timing, f*ds, len(roll), radius)
+        with instrument.stage('dp' if f == 1 else 'coarse dp'):
+            path = _ground_truth_path(pitches, timing, roll, f*ds, lmbda, engine, band, window, max_memory, threads)
+        if window is not None:
+            touches += np.sum(((path == window[0]) & (window[0] > 0)) | ((path == window[1]) & (window[1] < len(roll)-1)))
+            refined += len(path)
+        prev_timing,prev_ds = timing,f*ds
+
+    index_alignment = path
+    if touches > 0:
+        warnings.warn('{}: alignment touches the corridor at {} of {} refined score events'.format(
+            perf, touches, refined))
+
+    _check_band(perf, index_alignment, score_timing, len(perf_rep), ds, band)
+    return _ground_truth_alignment(index_alignment, score_durations, score_start, perf_start, ds)
+
+def align_ground_truth_sweep(score_midi, perf, lmbdas, strides=(512,), fs=44100, engine='fast', band=None, threads=1):
+    """
+        ground-truth alignments for each combination of lmbda and stride, as align_ground_truth computes them
+
+        the midi files are parsed once, and the pianoroll and local costs (which don't depend on lmbda)
+        are computed once per stride, so each additional lmbda costs just the DP and traceback
+
+        returns a dict mapping (stride, lmbda) to the alignment
+    """
+    with instrument.stage('load midi'):
+        score_pitches,score_durations,score_start,score_end = midi.load_midi_events_packed(score_midi)
+        perf_pitches,perf_durations,perf_start,perf_end = midi.load_midi_events_packed(perf + '.midi')
+    score_timing = score_durations.astype(np.float32)
+
+    alignments = {}
+    for stride in strides:
+        with instrument.stage('pianoroll'):
+            perf_rep = util.pianoroll_packed(perf_pitches, perf_durations, fs, stride)
+        ds = stride/fs
+        with instrument.stage('local costs'):
+            costs = gtalign.local_costs(score_pitches, score_timing, perf_rep, ds, band=band, threads=threads)
+        for lmbda in lmbdas:
+            with instrument.stage('dp'):
+                B = gtalign.align_backpointers(score_pitches, score_timing, perf_rep, ds, lmbda, engine=engine,
+                                               band=band, threads=threads, costs=costs)
+            with instrument.stage('backtrack'):
+                index_alignment = gtalign.backtrack(B)
+            _check_band(perf, index_alignment, score_timing, len(perf_rep), ds, band)
+            alignments[stride,lmbda] = _ground_truth_alignment(index_alignment, score_durations,
+                                                               score_start, perf_start, ds)
 
-    index_alignment = [dict(path)[i] for i in range(len(score_events))]
-    score_timing = score_start + np.cumsum(score_events[:,-1])
-    perf_timing = [perf_start + k*(stride/fs) for k in index_alignment]
+    return alignments
+
+def _check_band(perf, index_alignment, score_timing, K, ds, band):
+    """ warn about score events whose optimal tempo is pinned to the edge of the tempo band """
+    if band is None: return
+    dlo,dhi = gtalign.band_limits(score_timing, K, ds, band)
+    steps = np.diff(index_alignment)
+    edges = np.sum(((steps == dlo[1:]) & (dlo[1:] > 0)) | (steps == dhi[1:]))
+    if edges > 0:
+        warnings.warn('{}: alignment touches the tempo band {} at {} of {} score events'.format(
+            perf, band, edges, len(steps)))
+
+def _ground_truth_alignment(index_alignment, score_durations, score_start, perf_start, ds):
+    """ (score time, performance time) at the end of each score event, given the frame at which it ends """
+    score_timing = score_start + np.cumsum(score_durations)
+    perf_timing = [perf_start + k*ds for k in index_alignment]
     alignment = np.array(list(zip(score_timing,perf_timing)))
     return np.insert(alignment, 0, (score_start,perf_start), axis=0)
 
-def align_chroma(score_midi, perf, fs=44100, stride=512, n_fft=4096):
-    score_synth = pretty_midi.PrettyMIDI(score_midi).fluidsynth(fs=fs)
-    perf,_ = librosa.load(perf + '.wav', sr=fs)
-    score_chroma = librosa.feature.chroma_stft(y=score_synth, sr=fs, tuning=0, norm=2,
-                                               hop_length=stride, n_fft=n_fft)
-    score_logch = librosa.power_to_db(score_chroma, ref=score_chroma.max())
-    perf_chroma = librosa.feature.chroma_stft(y=perf, sr=fs, tuning=0, norm=2,
-                                              hop_length=stride, n_fft=n_fft)
-    perf_logch = librosa.power_to_db(perf_chroma, ref=perf_chroma.max())
-    D, wp = librosa.sequence.dtw(X=score_logch, Y=perf_logch)
-    path = np.array(list(reversed(np.asarray(wp))))
-
-    return np.array([(s,t) for s,t in dict(reversed(wp)).items()])*(stride/fs)
-
-def align_spectra(score_midi, perf, fs=44100, stride=512, n_fft=4096):
-    score_synth = pretty_midi.PrettyMIDI(score_midi).fluidsynth(fs=fs)
-    perf,_ = librosa.load(perf + '.wav', sr=fs)
-    score_spec = np.abs(librosa.stft(y=score_synth, hop_length=stride, n_fft=n_fft))**2
-    score_logspec = librosa.power_to_db(score_spec, ref=score_spec.max())
-    perf_spec = np.abs(librosa.stft(y=perf, hop_length=stride, n_fft=n_fft))**2
-    perf_logspec = librosa.power_to_db(perf_spec, ref=perf_spec.max())
-    D, wp = librosa.sequence.dtw(X=score_logspec, Y=perf_logspec)
-    path = np.array(list(reversed(np.asarray(wp))))
-
-    return np.array([(s,t) for s,t in dict(reversed(wp)).items()])*(stride/fs)
-
-def align_prettymidi(score_midi, perf, fs=22050, hop=512, note_start=36, n_notes=48, penalty=None):
+def _ground_truth_path(score, score_timing, perf, ds, lmbda, engine, band, window, max_memory, threads):
+    """ the performance frame at which each score event ends """
+    if max_memory is None:
+        with instrument.stage('align'): # keeps only the backpointers (not the J x K costs) in memory
+            B = gtalign.align_backpointers(score,score_timing,perf,ds,lmbda,engine=engine,band=band,window=window,
+                                           threads=threads)
+        with instrument.stage('backtrack'):
+            return gtalign.backtrack(B)
+    else: # bounded memory: checkpoint rows of the DP and recompute
+        with instrument.stage('align_path'):
+            return gtalign.align_path(score,score_timing,perf,ds,lmbda,engine=engine,band=band,window=window,
+                                      max_memory=max_memory,threads=threads)
+
+def _merge_events(pitches, durations, min_duration):
+    """ merge runs of consecutive packed events (union of pitches) until each lasts at least min_duration """
+    starts,elapsed = [0],0
+    for j,duration in enumerate(durations):
+        if elapsed >= min_duration:
+            starts.append(j)
+            elapsed = 0
+        elapsed += duration
+
+    return np.bitwise_or.reduceat(pitches, starts, axis=0),np.add.reduceat(durations, starts)
+
+def _merge_frames(roll, factor):
+    """ merge each block of factor frames of a packed pianoroll (union of pitches) """
+    return np.bitwise_or.reduceat(roll, np.arange(0,len(roll),factor), axis=0)
+
+def _corridor(path, coarse_timing, coarse_ds, timing, ds, K, radius):
+    """ frames within radius of a coarse path, projected onto finer score events and performance frames """
+    # a coarse frame covers several finer frames; project onto the center of the coarse frame
+    score_time = np.concatenate(([0],np.cumsum(coarse_timing,dtype=np.float64)))
+    perf_time = np.concatenate(([0],(path + .5)*coarse_ds - .5*ds))
+    projection = np.round(np.interp(np.cumsum(timing,dtype=np.float64), score_time, perf_time)/ds).astype(int)
+
+    wlo = np.clip(projection - radius, 0, K-1)
+    whi = np.clip(projection + radius, 0, K-1)
+    whi[-1] = K-1 # the path always ends in the final frame
+    return wlo,whi
+
+def align_chroma(score_midi, perf, fs=44100, stride=512, n_fft=4096, dtw='librosa', band=None, slope=None, radius=None):
+    return align_chroma_batch(score_midi, [perf], fs, stride, n_fft, dtw, band, slope, radius)[0]
+
+def align_chroma_batch(score_midi, perfs, fs=44100, stride=512, n_fft=4096, dtw='librosa', band=None, slope=None, radius=None):
+    """ align_chroma of several performances of the same score (see _align_features_batch); returns a list """
+    import lib.features as features
+    extract = lambda source, out: features.log_chroma(source, out, fs, stride, n_fft)
+    return _align_features_batch('chroma', 12, extract, score_midi, perfs, fs, stride, n_fft, dtw, band, slope, radius)
+
+def align_spectra(score_midi, perf, fs=44100, stride=512, n_fft=4096, dtw='librosa', band=None, slope=None, radius=None):
+    return align_spectra_batch(score_midi, [perf], fs, stride, n_fft, dtw, band, slope, radius)[0]
+
+def align_spectra_batch(score_midi, perfs, fs=44100, stride=512, n_fft=4096, dtw='librosa', band=None, slope=None, radius=None):
+    """ align_spectra of several performances of the same score (see _align_features_batch); returns a list """
+    import lib.features as features
+    extract = lambda source, out: features.log_spectra(source, out, stride, n_fft)
+    return _align_features_batch('spectra', 1+n_fft//2, extract, score_midi, perfs, fs, stride, n_fft, dtw, band, slope, radius)
+
+def _align_features_batch(kind, dim, extract, score_midi, perfs, fs, stride, n_fft, dtw, band, slope, radius):
+    """
+        DTW alignments of the features (dim x frames) computed by extract from the synthesized score
+        and from each performance: the score's features are computed (or loaded) once, and the costs
+        against every performance are computed together (see _dtw_batch, whose euclidean costs match
+        those of the single-performance aligners up to rounding)
+    """
+    params = dict(fs=fs, stride=stride, n_fft=n_fft)
+    with instrument.stage('features'):
+        score_features = _features(kind, score_midi, dict(params, synth=synth_version), dim,
+                                   lambda: _score_source(score_midi, fs), extract, dtype=np.float64)
+        perf_features = [_features(kind, perf + '.wav', params, dim, lambda perf=perf: _audio_source(perf + '.wav', fs), extract)
+                         for perf in perfs]
+    instrument.record(score_frames=score_features.shape[1])
+    for f in perf_features: instrument.record(perf_frames=f.shape[1])
+    paths = _dtw_batch(score_features.T, [f.T for f in perf_features], 'euclidean', dtw, band, slope, radius)
+
+    return [np.array([(s,t) for s,t in dict(reversed(wp)).items()])*(stride/fs) for wp in paths]
+
+def align_online(score_midi, perf, fs=44100, stride=512, n_fft=4096, block=2048, radius=256):
+    """
+        online time warping of chroma features (see lib/online.py), streaming perf + '.wav' in blocks of
+        samples as a live input would arrive; the score is synthesized in advance
+
+        returns the alignment and the processing latency (in seconds) of each block
+    """
+    return align_online_batch(score_midi, [perf], fs, stride, n_fft, block, radius)[0]
+
+def align_online_batch(score_midi, perfs, fs=44100, stride=512, n_fft=4096, block=2048, radius=256):
+    """ align_online of several performances of the same score, whose features are computed once; returns a list """
+    import lib.online as online
+    with instrument.stage('score features'):
+        params = dict(fs=fs, stride=stride, n_fft=n_fft, synth=synth_version)
+        score_logch = cache.load('online-chroma', [score_midi], params,
+                                 lambda: online.log_chroma(_synthesize(score_midi, fs), fs, stride, n_fft), dtype=np.float64)
+    instrument.record(score_frames=len(score_logch))
+    return [_follow(score_logch, perf, fs, stride, n_fft, block, radius) for perf in perfs]
+
+def _follow(score_logch, perf, fs, stride, n_fft, block, radius):
+    """ online alignment of a performance to the score features score_logch (see align_online) """
+    import lib.online as online
+    arrivals,latency,positions = [],[],[]
+    def arrive(blocks):
+        for samples in blocks:
+            arrivals.append(time.perf_counter())
+            yield samples
+
+    blocks = online.chroma_blocks(arrive(online.audio_blocks(perf + '.wav', fs, block)), fs, stride, n_fft)
+    with instrument.stage('follow'):
+        for reached in online.follow(score_logch, blocks, radius):
+            latency.append(time.perf_counter() - arrivals[len(latency)])
+            positions.extend(reached.tolist())
+    instrument.record(blocks=len(latency))
+
+    # the last performance frame at which each score frame was reached
+    alignment = np.array([(s,t) for s,t in dict(zip(positions, range(len(positions)))).items()])*(stride/fs)
+    return alignment, np.array(latency)
+
+def align_prettymidi(score_midi, perf, fs=22050, hop=512, note_start=36, n_notes=48, penalty=None,
+                     dtw='librosa', band=None, slope=None, radius=None):
     '''
     Align a MIDI object in-place to some audio data.
     Parameters
@@ -72,7 +271,18 @@ def align_prettymidi(score_midi, perf, fs=22050, hop=512, note_start=36, n_notes
         Number of notes to include in the CQT
     penalty : float
         DTW non-diagonal move penalty
+    dtw : str
+        DTW engine, 'librosa' or 'banded' (see _dtw for band, slope and radius)
+    '''
+    return align_prettymidi_batch(score_midi, [perf], fs, hop, note_start, n_notes, penalty, dtw, band, slope, radius)[0]
+
+def align_prettymidi_batch(score_midi, perfs, fs=22050, hop=512, note_start=36, n_notes=48, penalty=None,
+                           dtw='librosa', band=None, slope=None, radius=None):
+    '''
+    align_prettymidi of several performances of the same score, whose CQ-gram is computed once and
+    compared with all of theirs in one product (see _dtw_batch); returns a list
     '''
+    import librosa
     def extract_cqt(audio_data, fs, hop, note_start, n_notes):
         '''
         Compute a log-magnitude L2-normalized constant-Q-gram of some audio data.
@@ -96,9 +306,10 @@ def align_prettymidi(score_midi, perf, fs=22050, hop=512, note_start=36, n_notes
             Times, in seconds, of each frame in the CQT
         '''
         # Compute CQT
-        cqt = librosa.cqt(
-            audio_data, sr=fs, hop_length=hop,
-            fmin=librosa.midi_to_hz(note_start), n_bins=n_notes)
+        with instrument.stage('cqt'):
+            cqt = librosa.cqt(
+                audio_data, sr=fs, hop_length=hop,
+                fmin=librosa.midi_to_hz(note_start), n_bins=n_notes)
         # Transpose so that rows are spectra
         cqt = cqt.T
         # Compute log-amplitude
@@ -106,23 +317,124 @@ def align_prettymidi(score_midi, perf, fs=22050, hop=512, note_start=36, n_notes
         # L2 normalize the columns
         cqt = librosa.util.normalize(cqt, norm=2., axis=1)
         # Compute the time of each frame
-        times = librosa.frames_to_time(np.arange(cqt.shape[0]), fs, hop)
+        times = librosa.frames_to_time(np.arange(cqt.shape[0]), sr=fs, hop_length=hop)
         return cqt, times
 
-    audio_data, _ = librosa.load(perf + '.wav', fs)
-    midi_object = pretty_midi.PrettyMIDI(score_midi)
-    # Get synthesized MIDI audio
-    midi_audio = midi_object.fluidsynth(fs=fs)
-    # Compute CQ-grams for MIDI and audio
-    midi_gram, midi_times = extract_cqt(
-        midi_audio, fs, hop, note_start, n_notes)
-    audio_gram, audio_times = extract_cqt(
-        audio_data, fs, hop, note_start, n_notes)
-    # Compute distance matrix; because the columns of the CQ-grams are
-    # L2-normalized we can compute a cosine distance matrix via a dot product
-    distance_matrix = 1 - np.dot(midi_gram, audio_gram.T)
-    D, wp = librosa.sequence.dtw(C=distance_matrix)
-    path = np.array([(s,t) for s,t in dict(reversed(wp)).items()])
-    result = [(midi_times[x[0]], audio_times[x[1]]) for x in path]
-    return np.array(result)
+    # Compute CQ-grams for synthesized MIDI and audio (or reuse cached ones)
+    params = dict(fs=fs, hop=hop, note_start=note_start, n_notes=n_notes)
+    midi_gram = cache.load('cqt', [score_midi], dict(params, synth=synth_version), lambda: extract_cqt(
+        _synthesize(score_midi, fs), fs, hop, note_start, n_notes)[0], dtype=np.float64)
+    audio_grams = [cache.load('cqt', [perf + '.wav'], params, lambda perf=perf: extract_cqt(
+        _load_audio(perf + '.wav', fs), fs, hop, note_start, n_notes)[0]) for perf in perfs]
+    midi_times = librosa.frames_to_time(np.arange(midi_gram.shape[0]), sr=fs, hop_length=hop)
+    instrument.record(score_frames=midi_gram.shape[0])
+    for audio_gram in audio_grams: instrument.record(perf_frames=audio_gram.shape[0])
+    # Align; because the columns of the CQ-grams are L2-normalized
+    # we can compute a cosine distance matrix via a dot product
+    results = []
+    for audio_gram,wp in zip(audio_grams, _dtw_batch(midi_gram, audio_grams, 'dot', dtw, band, slope, radius)):
+        audio_times = librosa.frames_to_time(np.arange(audio_gram.shape[0]), sr=fs, hop_length=hop)
+        path = np.array([(s,t) for s,t in dict(reversed(wp)).items()])
+        result = [(midi_times[x[0]], audio_times[x[1]]) for x in path]
+        results.append(np.array(result))
+    return results
+
+@instrument.timed('dtw')
+def _dtw(X, Y, metric, dtw, band, slope, radius):
+    """
+        warping path between features X and Y (frames as rows) under metric (see dtwlib.metrics)
+
+        dtw='librosa' uses librosa.sequence.dtw; dtw='banded' uses lib/dtw.pyx, which computes costs on
+        the fly in O(window) memory, optionally within band frames of the diagonal and/or with the slope
+        limited to [1/slope,slope], or multiscale (FastDTW-style) within radius frames of a coarser path
+    """
+    if dtw == 'librosa':
+        import librosa
+        if (band,slope,radius) != (None,None,None): raise ValueError("band, slope and radius require dtw='banded'")
+        if metric == 'dot':
+            D, wp = librosa.sequence.dtw(C=1 - np.dot(X, Y.T))
+        else:
+            D, wp = librosa.sequence.dtw(X=X.T, Y=Y.T, metric=metric)
+    elif dtw == 'banded':
+        if radius is not None:
+            if (band,slope) != (None,None): raise ValueError('multiscale dtw (radius) does not take a band or slope')
+            _, wp = dtwlib.multiscale(X, Y, metric, radius)
+        else:
+            _, wp = dtwlib.dtw(X, Y, metric, *dtwlib.window(len(X), len(Y), band, slope))
+    else:
+        raise ValueError('unknown dtw engine: {}'.format(dtw))
+
+    return wp
+
+def _dtw_batch(X, Ys, metric, dtw, band, slope, radius):
+    """
+        warping paths between features X and each of Ys, as _dtw computes them
+
+        with dtw='librosa' (and more than one Y) the cost matrices against every Y are computed as one
+        product of X with the stacked Ys, then split. Dot costs are computed in the precision of the
+        features, as _dtw computes them; euclidean costs in float64 (as scipy's cdist computes them),
+        expanded as sqrt(|x|^2 + |y|^2 - 2 x.y), which equals the direct distances up to rounding (so
+        the paths can differ from _dtw's where paths tie or nearly tie). The banded engine computes
+        costs on the fly, so with dtw='banded' each Y is aligned separately
+    """
+    if dtw != 'librosa' or len(Ys) == 1: return [_dtw(X, Y, metric, dtw, band, slope, radius) for Y in Ys]
+
+    import librosa
+    if (band,slope,radius) != (None,None,None): raise ValueError("band, slope and radius require dtw='banded'")
+    if metric not in ('dot', 'euclidean'): raise ValueError('unsupported batch metric: {}'.format(metric))
+    with instrument.stage('dtw'):
+        dtype = None if metric == 'dot' else np.float64
+        X = np.asarray(X, dtype=dtype)
+        Y = np.concatenate([np.asarray(Y, dtype=dtype) for Y in Ys])
+        with instrument.stage('costs'):
+            C = np.dot(X, Y.T)
+            if metric == 'dot':
+                C = np.subtract(1, C, out=C)
+            else:
+                C *= -2
+                C += np.einsum('ij,ij->i', X, X)[:,None]
+                C += np.einsum('ij,ij->i', Y, Y)[None,:]
+                C = np.sqrt(np.maximum(C, 0, out=C), out=C)
+        del Y
+        return [librosa.sequence.dtw(C=C_k)[1] for C_k in np.split(C, np.cumsum([len(Y) for Y in Ys])[:-1], axis=1)]
+
+def _synthesize(score_midi, fs):
+    """ fluidsynth rendering of a score (cached as float64, so features are computed from the samples fluidsynth returns) """
+    import pretty_midi
+    def render():
+        with instrument.stage('synthesize'): return pretty_midi.PrettyMIDI(score_midi).fluidsynth(fs=fs)
+
+    return cache.load('synth', [score_midi], dict(fs=fs, synth=synth_version), render, dtype=np.float64)
+
+def _load_audio(wav, fs):
+    """ decoded and resampled performance audio (cached) """
+    import librosa
+    def decode():
+        with instrument.stage('load audio'): return librosa.load(wav, sr=fs)[0]
+
+    return cache.load('audio', [wav], dict(fs=fs), decode)
+
+def _score_source(score_midi, fs):
+    """ the samples of a synthesized score, for streaming feature extraction (see lib/features.py) """
+    return contextlib.nullcontext(_synthesize(score_midi, fs))
+
+def _audio_source(wav, fs):
+    """
+        the samples of a performance at fs, for streaming feature extraction (see lib/features.py):
+        the wav file itself if it is sampled at fs, otherwise its (cached) resampled audio
+    """
+    import soundfile
+    if soundfile.info(wav).samplerate == fs: return soundfile.SoundFile(wav)
+    return contextlib.nullcontext(_load_audio(wav, fs))
+
+def _features(kind, filename, params, dim, source, extract, dtype=np.float32):
+    """
+        features (dim x frames, of dtype) computed from filename by extract(samples, out), where samples
+        is opened by source(); streamed into the cache, and only computed if they aren't cached
+    """
+    import lib.features as features
+    def fill(allocate):
+        with source() as samples, instrument.stage('extract'):
+            extract(samples, allocate((dim, features.num_frames(samples, params['stride']))))
 
+    return cache.create(kind, [filename], params, fill, dtype)
@@ -0,0 +1,137 @@
+import os, json, hashlib, tempfile, zipfile
+import numpy as np
+
+#
+# content-addressed cache of intermediate arrays (synthesized audio, decoded audio, features, parsed midi)
+#
+# array entries are .npy files (float32, or float64 for synthesized scores and their features) named by
+# a hash of the contents of their input files and the parameters used to compute them; they are
+# memory-mapped when read and evicted least-recently-used once the cache grows beyond its size limit;
+# other entries are small .npz files of named arrays
+#
+
+root = os.environ.get('ALIGN_CACHE_DIR', 'cache')        # None disables the cache
+max_bytes = int(float(os.environ.get('ALIGN_CACHE_GB', 20))*2**30)
+
+_file_hashes = {}
+
+def configure(directory, size_gb=None):
+    """ set the cache directory (None to disable caching) and its size limit in GB """
+    global root, max_bytes
+    root = directory
+    if size_gb is not None: max_bytes = int(size_gb*2**30)
+
+def file_hash(filename):
+    """ hash of the contents of a file (memoized on path, size and modification time) """
+    st = os.stat(filename)
+    key = (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+    if key not in _file_hashes:
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''): h.update(block)
+        _file_hashes[key] = h.hexdigest()
+
+    return _file_hashes[key]
+
+def key(kind, inputs, params):
+    """ cache key for an array of the given kind, computed from input files with parameters """
+    desc = json.dumps([kind, [file_hash(f) for f in inputs], params], sort_keys=True)
+    return '{}-{}'.format(kind, hashlib.sha1(desc.encode()).hexdigest())
+
+def load(kind, inputs, params, compute, dtype=np.float32):
+    """
+        look up an array in the cache, calling compute() to create it if it isn't there
+
+        returns a read-only memory map of the cached array, stored as dtype
+        (or the result of compute() as dtype if caching is disabled)
+    """
+    if root is None: return np.asarray(compute(), dtype=dtype)
+
+    path = os.path.join(root, key(kind, inputs, params) + '.npy')
+    try:
+        x = np.load(path, mmap_mode='r')
+        os.utime(path) # mark as recently used
+        return x
+    except (FileNotFoundError, ValueError):
+        pass # missing (or truncated) entry
+
+    x = np.asarray(compute(), dtype=dtype)
+    _store(path, lambda f: np.save(f, x))
+
+    return np.load(path, mmap_mode='r')
+
+def create(kind, inputs, params, fill, dtype=np.float32):
+    """
+        like load, for an array that fill(allocate) computes incrementally: fill calls allocate(shape)
+        for an array of dtype to write into, which is the memory-mapped cache entry (so the array is never
+        held in memory)
+    """
+    if root is None:
+        arrays = []
+        fill(lambda shape: arrays.append(np.empty(shape, dtype=dtype)) or arrays[0])
+        return arrays[0]
+
+    path = os.path.join(root, key(kind, inputs, params) + '.npy')
+    try:
+        x = np.load(path, mmap_mode='r')
+        os.utime(path) # mark as recently used
+        return x
+    except (FileNotFoundError, ValueError):
+        pass # missing (or truncated) entry
+
+    def save(f):
+        out = []
+        fill(lambda shape: out.append(np.lib.format.open_memmap(f.name, mode='w+', dtype=dtype, shape=shape)) or out[0])
+        out[0].flush()
+    _store(path, save)
+
+    return np.load(path, mmap_mode='r')
+
+def load_arrays(kind, inputs, params, compute):
+    """
+        like load, for a dict of named arrays of any dtype returned by compute()
+
+        entries are stored as .npz and read into memory
+    """
+    if root is None: return compute()
+
+    path = os.path.join(root, key(kind, inputs, params) + '.npz')
+    try:
+        with np.load(path) as f: arrays = dict(f)
+        os.utime(path) # mark as recently used
+        return arrays
+    except (FileNotFoundError, ValueError, zipfile.BadZipFile):
+        pass # missing (or truncated) entry
+
+    arrays = compute()
+    _store(path, lambda f: np.savez(f, **arrays))
+
+    return arrays
+
+def _store(path, save):
+    os.makedirs(root, exist_ok=True)
+    fd,tmp = tempfile.mkstemp(dir=root, suffix='.tmp')
+    os.close(fd)
+    with open(tmp, 'wb') as f: save(f) # f.name is tmp, for writers that need a path
+    os.replace(tmp, path) # atomic, so concurrent workers never see a partial entry
+    evict()
+
+def evict():
+    """ remove least-recently-used entries until the cache fits in max_bytes """
+    entries = []
+    for name in os.listdir(root):
+        if not name.endswith(('.npy','.npz')): continue
+        try:
+            st = os.stat(os.path.join(root, name))
+            entries.append((st.st_mtime, st.st_size, name))
+        except FileNotFoundError:
+            pass # evicted by another process
+
+    total = sum(size for _,size,_ in entries)
+    for _,size,name in sorted(entries):
+        if total <= max_bytes: break
+        try:
+            os.remove(os.path.join(root, name))
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -0,0 +1,168 @@
+import numpy as np
+cimport numpy as np
+cimport cython
+from libc.math cimport INFINITY
+
+#
+# memory-efficient dynamic time warping: an alternative to librosa.sequence.dtw
+#
+# the cost matrix is never materialized: the DP runs row by row, computing the cost of each cell from
+# the features on the fly, and considers only the cells in a window [lo[i],hi[i]] of each row i.
+# the path is recovered from one uint8 step index per window cell, so memory is O(window size)
+# (plus two rows of accumulated cost) rather than several float64 N x M matrices
+#
+# with a full window, the path is the same as librosa.sequence.dtw's with its default steps
+# (ties go to the diagonal step, then the horizontal step, then the vertical step)
+#
+
+metrics = ('euclidean', 'dot')
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _dtw_row(const double[:] C, const double[:] prev, double[:] row, unsigned char[:] steps,
+                   int plo, int phi, int lo, int hi, bint first, double diagonal) noexcept nogil:
+    """
+        accumulated cost of the cells lo <= j <= hi of a row, given the local costs C of those cells
+        and the accumulated costs prev of the cells plo <= j <= phi of the previous row
+        (the local cost of a diagonal step is weighted by diagonal)
+    """
+    cdef int j
+    cdef double best, cost
+    cdef unsigned char step
+    for j in range(lo, hi+1):
+        best = C[0] if first and j == 0 else INFINITY # D[0,0] = C[0,0]
+        step = 0
+        if plo <= j-1 and j-1 <= phi: # diagonal step
+            cost = prev[j-1-plo] + diagonal*C[j-lo]
+            if cost < best: best,step = cost,0
+        if j-1 >= lo: # horizontal step
+            cost = row[j-1-lo] + C[j-lo]
+            if cost < best: best,step = cost,1
+        if plo <= j and j <= phi: # vertical step
+            cost = prev[j-plo] + C[j-lo]
+            if cost < best: best,step = cost,2
+        row[j-lo] = best
+        steps[j-lo] = step
+
+def accumulate(C, prev, row, plo, phi, lo, hi, first=False, diagonal=1.):
+    """
+        one row of the DP (see _dtw_row): fills row[:hi-lo+1] with the accumulated costs of the cells
+        lo <= j <= hi, without recording steps; for online (streaming) DTW
+    """
+    _dtw_row(C, prev, row, np.empty(hi-lo+1, dtype=np.uint8), plo, phi, lo, hi, first, diagonal)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef backtrack(const unsigned char[:] steps, const np.int64_t[:] offset, const int[:] lo, int M):
+    """ the warping path from (N-1,M-1) back to (0,0) (ordered as librosa returns it) """
+    cdef int i = lo.shape[0]-1, j = M-1
+    cdef int n = 0
+    cdef unsigned char step
+    npwp = np.empty((i+j+1,2), dtype=np.int64)
+    cdef np.int64_t[:,:] wp = npwp
+    while True:
+        wp[n,0],wp[n,1] = i,j
+        n += 1
+        if i == 0 and j == 0: break
+
+        step = steps[offset[i] + j - lo[i]]
+        if step == 0: i,j = i-1,j-1
+        elif step == 1: j -= 1
+        else: i -= 1
+
+    return npwp[:n]
+
+def window(N, M, band=None, slope=None):
+    """
+        per-row limits lo,hi (int32^N) of the cells considered for an N x M DTW:
+
+          band  - Sakoe-Chiba band: only cells within band frames of the diagonal from (0,0) to (N-1,M-1)
+          slope - parallelogram: the path's slope (relative to the diagonal) must stay within [1/slope,slope]
+    """
+    lo,hi = np.zeros(N), np.full(N, M-1.)
+    x = np.arange(N)/max(N-1,1)
+    if band is not None:
+        if band < 0: raise ValueError('band must be nonnegative')
+        lo,hi = np.maximum(lo, np.floor(x*(M-1) - band)), np.minimum(hi, np.ceil(x*(M-1) + band))
+    if slope is not None:
+        if slope < 1: raise ValueError('slope must be at least 1')
+        lo = np.maximum(lo, np.floor((M-1)*np.maximum(x/slope, 1 - (1-x)*slope)))
+        hi = np.minimum(hi, np.ceil((M-1)*np.minimum(x*slope, 1 - (1-x)/slope)))
+
+    lo,hi = np.clip(lo, 0, M-1).astype(np.int32), np.clip(hi, 0, M-1).astype(np.int32)
+    lo[0],hi[-1] = 0,M-1
+    return _connect(lo, hi)
+
+def _connect(lo, hi):
+    """ widen the window where needed so that each row can be entered by a step from the previous row """
+    lo[1:] = np.minimum(lo[1:], hi[:-1]+1)
+    hi[:] = np.maximum(hi, lo)
+    return lo,hi
+
+def dtw(X, Y, metric='euclidean', lo=None, hi=None):
+    """
+        DTW between features X (N x d) and Y (M x d), with frames as rows, within the window lo,hi
+        (see window; defaults to the full N x M matrix)
+
+        metric is 'euclidean' or 'dot' (1 - x.y, the cosine distance of L2-normalized features)
+
+        returns the total cost and the warping path, from (N-1,M-1) back to (0,0)
+    """
+    if metric not in metrics: raise ValueError('unknown metric: {}'.format(metric))
+
+    N,M = len(X),len(Y)
+    if lo is None: lo,hi = window(N, M)
+    lo,hi = np.ascontiguousarray(lo, dtype=np.int32),np.ascontiguousarray(hi, dtype=np.int32)
+    if metric == 'euclidean': # cdist computes in double; convert once rather than per row
+        from scipy.spatial.distance import cdist # scipy is slow to import, so only when it's needed
+        X,Y = np.ascontiguousarray(X, dtype=np.float64),np.ascontiguousarray(Y, dtype=np.float64)
+    else:
+        X,Y = np.ascontiguousarray(X, dtype=np.float32),np.ascontiguousarray(Y, dtype=np.float32)
+
+    offset = np.zeros(N+1, dtype=np.int64)
+    offset[1:] = np.cumsum(hi - lo + 1)
+    steps = np.empty(offset[-1], dtype=np.uint8)
+
+    prev,row = np.empty(0),np.empty(0)
+    for i in range(N):
+        if metric == 'euclidean':
+            C = cdist(X[i:i+1], Y[lo[i]:hi[i]+1])[0]
+        else:
+            C = (1 - np.dot(Y[lo[i]:hi[i]+1], X[i])).astype(np.float64)
+
+        prev,row = row,np.empty(hi[i]-lo[i]+1)
+        plo,phi = (lo[i-1],hi[i-1]) if i > 0 else (0,-1)
+        _dtw_row(C, prev, row, steps[offset[i]:offset[i+1]], plo, phi, lo[i], hi[i], i == 0, 1.)
+
+    if hi[N-1] != M-1 or not np.isfinite(row[-1]):
+        raise ValueError('No valid warping path within the window')
+
+    return row[-1], backtrack(steps, offset[:-1], lo, M)
+
+def multiscale(X, Y, metric='euclidean', radius=16):
+    """
+        approximate DTW in the manner of FastDTW: align coarsened (2x) features recursively, then align
+        X and Y within radius frames of the projected coarser path; returns the same as dtw
+    """
+    N,M = len(X),len(Y)
+    if min(N,M) <= 2*(radius+1): return dtw(X, Y, metric)
+
+    _,wp = multiscale(_coarsen(X), _coarsen(Y), metric, radius)
+
+    # the fine rows and columns covered by the coarse path
+    lo,hi = np.full((N+1)//2, M), np.full((N+1)//2, -1)
+    np.minimum.at(lo, wp[:,0], wp[:,1])
+    np.maximum.at(hi, wp[:,0], wp[:,1])
+    lo,hi = np.repeat(2*lo, 2)[:N], np.repeat(2*hi+1, 2)[:N]
+
+    # dilated by radius frames in each direction
+    lo = np.lib.stride_tricks.sliding_window_view(np.pad(lo, radius, mode='edge'), 2*radius+1).min(axis=1) - radius
+    hi = np.lib.stride_tricks.sliding_window_view(np.pad(hi, radius, mode='edge'), 2*radius+1).max(axis=1) + radius
+    lo,hi = np.clip(lo, 0, M-1).astype(np.int32), np.clip(hi, 0, M-1).astype(np.int32)
+
+    return dtw(X, Y, metric, *_connect(lo, hi))
+
+def _coarsen(X):
+    """ average each pair of frames (the last frame of an odd number stands alone) """
+    if len(X) % 2: X = np.concatenate([X, X[-1:]])
+    return (X[0::2] + X[1::2])/2
@@ -0,0 +1,92 @@
+import numpy as np
+import librosa, soundfile
+
+#
+# streaming feature extraction: spectrogram and chroma features computed a chunk of frames at a time
+#
+# the samples come from a source: an array (e.g. a memory-mapped cache entry) or an open
+# soundfile.SoundFile, read as needed; the features are written into an output array (e.g. a
+# memory-mapped cache entry, see cache.create), so neither the audio nor the float64/complex
+# intermediates of the whole piece are ever held in memory
+#
+# the features are frame-for-frame equal to computing them over the whole signal with librosa
+# (centered STFT frames, dB relative to the loudest frame)
+#
+
+def source_length(source):
+    """ number of samples in a source """
+    return source.frames if isinstance(source, soundfile.SoundFile) else len(source)
+
+def read(source, start, stop):
+    """
+        mono samples [start,stop) of a source, zero outside the source (as librosa.load would read them):
+        float32 from a file, or in the dtype of an array (e.g. a float64 synthesized score)
+    """
+    samples = np.zeros(stop-start, dtype=np.float32 if isinstance(source, soundfile.SoundFile) else source.dtype)
+    a,b = max(start,0),min(stop,source_length(source))
+    if a < b:
+        if isinstance(source, soundfile.SoundFile):
+            source.seek(a)
+            x = source.read(b-a, dtype='float32', always_2d=True)
+            samples[a-start:b-start] = x[:,0] if x.shape[1] == 1 else np.mean(x.T, axis=0)
+        else:
+            samples[a-start:b-start] = source[a:b]
+
+    return samples
+
+min_chunk = 64
+
+def num_frames(source, stride=512):
+    """ number of (centered) STFT frames of a source """
+    return 1 + source_length(source)//stride
+
+def power_spectra(source, stride=512, n_fft=4096, chunk=512):
+    """
+        yields (t, S) for consecutive chunks of frames of the power spectrogram of a source, where
+        S = np.abs(librosa.stft(y, hop_length=stride, n_fft=n_fft))**2 for frames [t,t+chunk)
+
+        chunks have at least min_chunk frames (a short final chunk is merged into the one before):
+        BLAS computes products with very few columns differently, and log_chroma must match
+        chroma_stft's product over the whole piece exactly
+    """
+    chunk = max(chunk, min_chunk)
+    frames = num_frames(source, stride)
+    t = 0
+    while t < frames:
+        u = t+chunk if frames - (t+chunk) >= min_chunk else frames
+        # the samples under frames [t,u), centered on t*stride (zero-padded at the ends like librosa)
+        y = read(source, t*stride - n_fft//2, (u-1)*stride + n_fft - n_fft//2)
+        yield t, np.abs(librosa.stft(y=y, hop_length=stride, n_fft=n_fft, center=False))**2
+        t = u
+
+def log_spectra(source, out, stride=512, n_fft=4096, chunk=512):
+    """
+        fill out (1+n_fft/2 x frames) with the log-power spectrogram of a source, i.e.
+        librosa.power_to_db(S, ref=S.max()) for S = np.abs(librosa.stft(y, hop_length=stride, n_fft=n_fft))**2
+    """
+    peak = 0
+    for t,S in power_spectra(source, stride, n_fft, chunk):
+        out[:,t:t+S.shape[1]] = S
+        peak = max(peak, S.max())
+
+    _to_db(out, peak, chunk)
+
+def log_chroma(source, out, fs=44100, stride=512, n_fft=4096, chunk=512):
+    """
+        fill out (12 x frames) with the log-chroma of a source, i.e. librosa.power_to_db(C, ref=C.max())
+        for C = librosa.feature.chroma_stft(y=y, sr=fs, tuning=0, norm=2, hop_length=stride, n_fft=n_fft)
+    """
+    filterbank = librosa.filters.chroma(sr=fs, n_fft=n_fft, tuning=0)
+    peak = 0
+    for t,S in power_spectra(source, stride, n_fft, chunk):
+        chroma = librosa.util.normalize(np.einsum("cf,...ft->...ct", filterbank, S, optimize=True), norm=2, axis=-2)
+        out[:,t:t+chroma.shape[1]] = chroma
+        peak = max(peak, chroma.max())
+
+    _to_db(out, peak, chunk)
+
+def _to_db(out, peak, chunk, top_db=80.0):
+    """ librosa.power_to_db(out, ref=out.max()) in place, a chunk of frames at a time """
+    floor = librosa.power_to_db(np.array([peak]), ref=peak, top_db=None)[0] - top_db # the largest dB value is the peak's
+    for t in range(0, out.shape[1], chunk):
+        out[:,t:t+chunk] = np.maximum(librosa.power_to_db(out[:,t:t+chunk], ref=peak, top_db=None), floor)
@@ -1,112 +1,564 @@
 import numpy as np
 cimport numpy as np
 cimport cython
-from libc.math cimport sqrt
+from cython.parallel cimport prange
+from libc.math cimport sqrt, INFINITY
+
+cdef extern from *:
+    int __builtin_popcountll(unsigned long long) nogil
+
+cdef extern from *:
+    """
+    #ifdef _OPENMP
+    #define GTALIGN_OPENMP 1
+    #else
+    #define GTALIGN_OPENMP 0
+    #endif
+    """
+    int GTALIGN_OPENMP
+
+engines = ('legacy', 'fast')
+
+# the threads argument of align and align_path is ignored (everything runs serially)
+# unless this module was compiled with OpenMP; see gtalign.pyxbld
+openmp = bool(GTALIGN_OPENMP)
+
+#
+# score and performance frames are bit-packed pitch sets (see midi.pack_pitches):
+# two uint64 words per frame, with pitch i at bit i%64 of word i//64
+#
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _local_cost_row(const np.uint64_t[:,:] score, const np.uint64_t[:,:] perf, int j, float[:] out,
+                          int klo, int khi, int threads) noexcept nogil:
+    """
+        the local cost of aligning score[j] with each perf[k], klo <= k <= khi: the L1 distance between
+        binary pitch vectors, i.e. the number of pitches in which they differ, popcount(xor)
+    """
+    cdef int k
+    cdef np.uint64_t s0 = score[j,0]
+    cdef np.uint64_t s1 = score[j,1]
+    for k in prange(klo,khi+1, num_threads=threads, schedule='static'):
+        out[k] = __builtin_popcountll(s0 ^ perf[k,0]) + __builtin_popcountll(s1 ^ perf[k,1])
+
+def local_cost(score, perf, j):
+    """ the local cost of aligning score[j] with each perf[k] as a float32 array """
+    out = np.empty(len(perf), dtype=np.float32)
+    _local_cost_row(score, perf, j, out, 0, len(perf)-1, 1)
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _row_base(float[:] local_cost, float[:] row, int khi,
+                    float ds, float sj, float prior, float lmbda) noexcept nogil:
+    """ base case j = 0: score[0] is aligned to perf[0..k], k <= khi """
+    cdef int k
+    cdef float tmp,instantaneous_tempo,incremental_cost,R
+    incremental_cost = 0
+    for k in range(0,khi+1):
+        instantaneous_tempo = (k*ds)/sj
+        tmp = instantaneous_tempo - prior
+        R = lmbda*tmp*tmp
+        incremental_cost += local_cost[k]
+        row[k] = incremental_cost*ds + R
+
+    row[0] = 0 # base case
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _cell_legacy(float[:] prev, float[:] local_cost, float[:] row, int[:] arg, bint record, int k,
+                       int p, int q, int dlo, int dhi, float ds, float sj, float prior, float lmbda) noexcept nogil:
+    """ update row[k] (initialized to inf) from prev, finite on [p,q], by scanning every predecessor m """
+    cdef float cost,tmp,instantaneous_tempo,incremental_cost,R
+    cdef int m
+    incremental_cost = 0
+    # go backward to incrementally compute mean cost
+
+    # limit tempo search to the band: k-dhi <= m <= k-dlo
+    # and to predecessors with finite cost: p <= m <= q
+    # (the unrestricted range is range(0,k+1))
+    for m in reversed(range(max(p,k-dhi),k+1)):
+        if k-m < dlo or m > q: # too fast; skip, but keep accumulating the cost
+            incremental_cost += local_cost[m]
+            continue
+
+        # instantaneous tempo over score event j is
+        # elapsed duration in the performance (k-m)*ds divided by elapsed time in the score score_timing[j]
+        instantaneous_tempo = ((k-m)*ds)/sj
+
+        # I *think* the python power operator translates to the same as repeat multiply here
+        # but in the non-cython setting (i.e. traceback it casts to 64-bit) so we need to
+        # do the multiply manually in numpy 32-bit floats over there; doing the same here
+        # seems safest...
+        tmp = instantaneous_tempo - prior
+        R = lmbda*tmp*tmp
+
+        # cost is cost of advancing from previous state L[j-1,m]
+        # plus the cost of aligning score[j] to (performance[m],performance[k]]
+        # plus regularization for the tempo required to make this step
+        cost = prev[m] + incremental_cost*ds + R
+
+        # track the minimum cost to reach state L[j,k]
+        if cost < row[k]:
+            row[k] = cost
+            if record: arg[k] = m
+
+        # the cost of aligning score[j] to (performance[m],...,performance[k]]
+        #     =  cost of aligning score[j] to (performance[m+1],...,performance[k]]
+        #     + cost of aligning score[j] 
+        #     = int_{m}^k \|score[j] - perf[m]\|_1 \,dt
+        incremental_cost += local_cost[m]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _row_legacy(float[:] prev, float[:] local_cost, float[:] row, int[:] arg, bint record,
+                      int p, int q, int klo, int khi, int dlo, int dhi,
+                      float ds, float sj, float prior, float lmbda, int threads) noexcept nogil:
+    """
+        update row[klo..khi] (initialized to inf) from prev, finite on [p,q]
+
+        the cells of a row are independent
+    """
+    cdef int k
+    for k in prange(klo,khi+1, num_threads=threads, schedule='dynamic', chunksize=64): # y-axis (performance)
+        _cell_legacy(prev, local_cost, row, arg, record, k, p, q, dlo, dhi, ds, sj, prior, lmbda)
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cpdef align(float[:,:] score, float[:,:] perf, float ds, float lmbda):
-    cdef float[:] score_timing = score[:,128]
+cdef void _row_minima(float[:] prev, double[:] Q, float[:] row, int[:] arg, int klo, int khi, int mlo, int mhi,
+                      int dlo, int dhi, double ds, double sj, double prior, double lmbda) noexcept nogil:
+    """
+        monotone-minima (divide and conquer) update of row[klo..khi] given the previous row
+
+        row[k] = min_{k-dhi <= m <= k-dlo} prev[m] + ds*(Q[k+1]-Q[m+1]) + lmbda*((k-m)*ds/sj - prior)**2
+
+        the tempo penalty is a convex function of k-m, so the (rightmost) minimizing m is
+        non-decreasing in k and we only need to search [mlo,mhi] for rows in [klo,khi]
+
+        the minimizing m is written to arg[k]
+    """
+    cdef int k,m,best_m
+    cdef double cost,best,tmp
+    if klo > khi: return
+
+    k = (klo+khi)//2
+    best = INFINITY
+    best_m = max(mlo,k-dhi)
+    for m in range(max(mlo,k-dhi),min(mhi,k-dlo)+1):
+        tmp = ((k-m)*ds)/sj - prior
+        cost = prev[m] + ds*(Q[k+1]-Q[m+1]) + lmbda*tmp*tmp
+        if cost <= best: # ties go to the largest m, like the legacy scan
+            best = cost
+            best_m = m
+    row[k] = best
+    arg[k] = best_m
+
+    _row_minima(prev, Q, row, arg, klo, k-1, mlo, best_m, dlo, dhi, ds, sj, prior, lmbda)
+    _row_minima(prev, Q, row, arg, k+1, khi, best_m, mhi, dlo, dhi, ds, sj, prior, lmbda)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _row_fast(float[:] prev, float[:] local_cost, double[:] Q, float[:] row, int[:] arg,
+                    int p, int q, int klo, int khi, int dlo, int dhi,
+                    double ds, double sj, double prior, double lmbda, int threads) noexcept nogil:
+    """
+        update row[klo..khi] (initialized to inf) from prev, finite on [p,q]
+
+        with several threads, we first solve threads-1 evenly spaced pivot cells by brute force;
+        their minimizers split the row into independent monotone-minima subproblems
+    """
+    cdef int k,i,lo,hi,mlo,mhi
+    cdef int n = khi-klo+1
+
+    # Q[k+1] = sum_{p < i <= k} local_cost[i]
+    # (local costs are integers, so these differences are exact)
+    Q[p+1] = 0
+    for k in range(p+1,khi+1):
+        Q[k+1] = Q[k] + local_cost[k]
+
+    if threads <= 1 or n < 64*threads:
+        _row_minima(prev, Q, row, arg, klo, khi, p, q, dlo, dhi, ds, sj, prior, lmbda)
+        return
+
+    # pivot i is the cell klo + (i*n)//threads
+    for i in prange(1,threads, num_threads=threads, schedule='static'):
+        k = klo + (i*n)//threads
+        _row_minima(prev, Q, row, arg, k, k, p, q, dlo, dhi, ds, sj, prior, lmbda)
+    for i in prange(0,threads, num_threads=threads, schedule='static'):
+        lo = klo + (i*n)//threads + (1 if i > 0 else 0)
+        hi = klo + ((i+1)*n)//threads - 1
+        mlo = arg[lo-1] if i > 0 else p
+        mhi = arg[hi+1] if i < threads-1 else q
+        _row_minima(prev, Q, row, arg, lo, hi, mlo, mhi, dlo, dhi, ds, sj, prior, lmbda)
+
+def band_limits(score_timing, K, ds, band=None):
+    """
+        limits on the number of performance frames d = k-m that score event j may occupy
+
+        band = (lo,hi) restricts the instantaneous tempo d*ds/score_timing[j] to [lo*prior,hi*prior)
+        band = None allows any d in [0,K-1]
+
+        returns int32 arrays dlo,dhi with dlo[j] <= d <= dhi[j]
+    """
+    score_timing = np.asarray(score_timing, dtype=np.float32)
+    dlo = np.zeros(len(score_timing), dtype=np.int32)
+    dhi = np.full(len(score_timing), K-1, dtype=np.int32)
+    if band is None: return dlo,dhi
+
+    lo,hi = band
+    if not 0 <= lo < hi: raise ValueError('Invalid tempo band: {}'.format(band))
+
+    ds = np.float32(ds)
+    prior = (ds*np.float32(K))/np.cumsum(score_timing)[len(score_timing)-1]
+    frames = (np.float64(prior)*score_timing)/np.float64(ds) # frames at the prior tempo
+    dlo[:] = np.clip(np.ceil(lo*frames), 0, K-1)
+    dhi[:] = np.clip(np.ceil(hi*frames) - 1, dlo, K-1) # at least one admissible d
+    return dlo,dhi
+
+def reachable(K, dlo, dhi, window=None):
+    """
+        the range of performance frames a[j] <= k <= b[j] for which L[j,k] is finite
+
+        dlo,dhi are the band limits (see band_limits) and window = (wlo,whi) optionally
+        restricts score event j to end at a frame wlo[j] <= k <= whi[j]
+
+        rows that can't be reached have a[j] > b[j]
+    """
+    J = len(dlo)
+    wlo,whi = (np.zeros(J,dtype=np.int64),np.full(J,K-1,dtype=np.int64)) if window is None else window
+    a = np.full(J, K, dtype=np.int32)
+    b = np.full(J, -1, dtype=np.int32)
+    a[0],b[0] = max(wlo[0],0),min(whi[0],K-1)
+    for j in range(1,J):
+        if a[j-1] > b[j-1]: break # and so are all the rows that follow
+        a[j] = max(wlo[j],a[j-1]+dlo[j])
+        b[j] = min(whi[j],b[j-1]+dhi[j],K-1)
+
+    return a,b
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def local_costs(const np.uint64_t[:,:] score, const float[:] score_timing, const np.uint64_t[:,:] perf,
+                float ds, band=None, window=None, int threads=1):
+    """
+        the J x K local cost matrix used by align with the same band and window (only the cells
+        within reach of the band/window are computed; see reachable)
+
+        the local costs don't depend on lmbda, so they can be computed once and passed to align
+        (costs=...) for each of several values of lmbda
+    """
+    npdlo,npdhi = band_limits(score_timing, len(perf), ds, band)
+    npa,npb = reachable(len(perf), npdlo, npdhi, window)
+    cdef int[:] a = npa
+    cdef int[:] b = npb
+
+    cdef np.ndarray[np.float32_t, ndim=2] npC = np.empty((len(score),len(perf)), dtype=np.float32)
+    cdef float[:,:] C = npC
+    cdef int j,lo
+    with nogil:
+        for j in prange(0,score.shape[0], num_threads=threads, schedule='static'):
+            lo = a[j-1] if j > 0 else 0
+            if lo <= b[j]: _local_cost_row(score, perf, j, C[j], lo, b[j], 1)
+
+    return npC
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cpdef align(const np.uint64_t[:,:] score, const float[:] score_timing, const np.uint64_t[:,:] perf,
+            float ds, float lmbda, engine='fast', band=None, window=None, backpointers=False, int threads=1,
+            costs=None):
+    """
+        align packed score events (with durations score_timing) to packed performance frames
+
+        engine='legacy' scans every predecessor m for every cell: O(J*K^2)
+        engine='fast' (the default, as for align_path and traceback) solves each row with prefix
+        sums and monotone minima: O(J*K*log(K))
+
+        both engines compute the same recurrence (up to float rounding)
+
+        band = (lo,hi) restricts the tempo of each score event to [lo*prior,hi*prior)
+        (see band_limits); the first score event is not restricted
+
+        window = (wlo,whi) restricts score event j to end at a performance frame wlo[j] <= k <= whi[j];
+        only the local costs and cells within reach of the window are computed (see reachable)
+
+        backpointers=True also returns B, where B[j,k] is the minimizing predecessor m of
+        L[j,k] (-1 if unreachable); follow it with backtrack(B) instead of calling traceback
+
+        align keeps the full J x K cost matrix L; see align_backpointers for the backpointers alone,
+        and align_path for a memory-bounded alternative
+
+        threads > 1 parallelizes the local costs and each row of the DP (requires OpenMP)
+
+        costs is the local cost matrix, if already computed by local_costs (with the same band and window)
+    """
+    if engine not in engines: raise ValueError('Unknown engine: {}'.format(engine))
+    if threads < 1: raise ValueError('threads must be positive')
+    if costs is not None and costs.shape != (len(score),len(perf)):
+        raise ValueError('Local costs of shape {} for {} score events and {} frames'.format(costs.shape, len(score), len(perf)))
+
     cdef float prior = (ds*perf.shape[0])/np.cumsum(score_timing)[len(score_timing)-1] # slope = rise/run
     
     cdef np.ndarray[np.float32_t, ndim=2] npL = np.full((len(score),len(perf)), np.inf, dtype=np.float32)
     cdef float[:,:] L = npL # memory view for cheap access
 
-    cdef float cost,tmp,sj,instantaneous_tempo,incremental_cost,R
-    cdef int j,k,m,i
+    cdef int j
+    cdef bint fast = engine == 'fast'
 
-    cdef np.ndarray[np.float32_t, ndim=2] npC = np.empty((len(score),len(perf)), dtype=np.float32)
-    cdef float[:,:] local_cost = npC
-
-    # precompute the local cost of aligning score[j] with perf[k]
-    for j in range(0,len(score)):
-        for k in range(0,len(perf)):
-            local_cost[j,k] = 0
-            for i in range(128):
-                tmp = score[j,i] - perf[k,i]
-                local_cost[j,k] += tmp if tmp > 0 else -tmp
-
-    # base case j = 0
-    sj = score_timing[0]
-    incremental_cost = 0
-    for k in range(0,len(perf)):
-        instantaneous_tempo = (k*ds)/sj
-        tmp = instantaneous_tempo - prior
-        R = lmbda*tmp*tmp
-        incremental_cost += local_cost[0,k]
-        L[0,k] = incremental_cost*ds + R
+    npdlo,npdhi = band_limits(score_timing, len(perf), ds, band)
+    cdef int[:] dlo = npdlo
+    cdef int[:] dhi = npdhi
+
+    npa,npb = reachable(len(perf), npdlo, npdhi, window)
+    cdef int[:] a = npa
+    cdef int[:] b = npb
+
+    # backpointers; a single scratch row when we aren't recording them
+    cdef bint record = backpointers
+    cdef np.ndarray[np.int32_t, ndim=2] npB = np.full((len(score) if record else 1,len(perf)), -1, dtype=np.int32)
+    cdef int[:,:] B = npB
+
+    # precompute the local cost of aligning score[j] with perf[k] (wherever we need it)
+    if costs is None: costs = local_costs(score, score_timing, perf, ds, band, window, threads)
+    cdef float[:,:] local_cost = costs
+
+    cdef double[:] Q = np.zeros(len(perf)+1, dtype=np.float64)
+    with nogil:
+        if a[0] <= b[0]:
+            _row_base(local_cost[0], L[0], b[0], ds, score_timing[0], prior, lmbda)
+            L[0,:a[0]] = INFINITY
+
+        for j in range(1,score.shape[0]): # x-axis (score)
+            if a[j] > b[j]: break # no path fits in the band/window
+            if fast:
+                _row_fast(L[j-1], local_cost[j], Q, L[j], B[j if record else 0], a[j-1], b[j-1], a[j], b[j],
+                          dlo[j], dhi[j], ds, score_timing[j], prior, lmbda, threads)
+            else:
+                _row_legacy(L[j-1], local_cost[j], L[j], B[j if record else 0], record, a[j-1], b[j-1], a[j], b[j],
+                            dlo[j], dhi[j], ds, score_timing[j], prior, lmbda, threads)
+
+    return (npL,npB) if record else npL
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cpdef align_backpointers(const np.uint64_t[:,:] score, const float[:] score_timing, const np.uint64_t[:,:] perf,
+                         float ds, float lmbda, engine='fast', band=None, window=None, int threads=1, costs=None):
+    """
+        the backpointers B of align(..., backpointers=True) without the J x K cost matrix L: only two
+        rows of L are kept and, unless costs is given (see local_costs), the local costs are computed
+        a row at a time, so B is the only J x K array; follow it with backtrack(B)
+    """
+    if engine not in engines: raise ValueError('Unknown engine: {}'.format(engine))
+    if threads < 1: raise ValueError('threads must be positive')
+    if costs is not None and costs.shape != (len(score),len(perf)):
+        raise ValueError('Local costs of shape {} for {} score events and {} frames'.format(costs.shape, len(score), len(perf)))
+
+    cdef int J = score.shape[0]
+    cdef int K = perf.shape[0]
+    cdef float prior = (ds*K)/np.cumsum(score_timing)[len(score_timing)-1] # slope = rise/run
+
+    npdlo,npdhi = band_limits(score_timing, K, ds, band)
+    cdef int[:] dlo = npdlo
+    cdef int[:] dhi = npdhi
+
+    npa,npb = reachable(K, npdlo, npdhi, window)
+    cdef int[:] a = npa
+    cdef int[:] b = npb
+
+    cdef np.ndarray[np.int32_t, ndim=2] npB = np.full((J,K), -1, dtype=np.int32)
+    cdef int[:,:] B = npB
+    cdef float[:,:] rows = np.full((2,K), np.inf, dtype=np.float32)
+    cdef float[:] local_cost = np.empty(K, dtype=np.float32)
+    cdef double[:] Q = np.zeros(K+1, dtype=np.float64)
+    cdef bint precomputed = costs is not None
+    cdef float[:,:] C = costs if precomputed else np.empty((1,1), dtype=np.float32)
+
+    cdef int j
+    cdef bint fast = engine == 'fast'
+    with nogil:
+        if a[0] <= b[0]:
+            if precomputed: local_cost = C[0]
+            else: _local_cost_row(score, perf, 0, local_cost, 0, b[0], threads)
+            _row_base(local_cost, rows[0], b[0], ds, score_timing[0], prior, lmbda)
+            rows[0,:a[0]] = INFINITY
+
+        for j in range(1,J):
+            if a[j] > b[j]: break # no path fits in the band/window
+            if not precomputed:
+                _advance(score, perf, j, rows[(j-1)%2], rows[j%2], B[j], local_cost, Q, fast,
+                         a[j-1], b[j-1], a[j], b[j], dlo[j], dhi[j], ds, score_timing[j], prior, lmbda, threads)
+                continue
+
+            rows[j%2,:] = INFINITY
+            if fast:
+                _row_fast(rows[(j-1)%2], C[j], Q, rows[j%2], B[j], a[j-1], b[j-1], a[j], b[j],
+                          dlo[j], dhi[j], ds, score_timing[j], prior, lmbda, threads)
+            else:
+                _row_legacy(rows[(j-1)%2], C[j], rows[j%2], B[j], True, a[j-1], b[j-1], a[j], b[j],
+                            dlo[j], dhi[j], ds, score_timing[j], prior, lmbda, threads)
+
+    return npB
+
+cdef void _advance(const np.uint64_t[:,:] score, const np.uint64_t[:,:] perf, int j, float[:] prev, float[:] row, int[:] arg,
+                   float[:] local_cost, double[:] Q, bint fast, int p, int q, int klo, int khi, int dlo, int dhi,
+                   float ds, float sj, float prior, float lmbda, int threads) noexcept nogil:
+    """ compute row j of L (and its backpointers) from row j-1 without the full local cost matrix """
+    row[:] = INFINITY
+    arg[:] = -1
+    if klo > khi: return # no path fits in the band/window
+
+    _local_cost_row(score, perf, j, local_cost, p, khi, threads)
+    if fast:
+        _row_fast(prev, local_cost, Q, row, arg, p, q, klo, khi, dlo, dhi, ds, sj, prior, lmbda, threads)
+    else:
+        _row_legacy(prev, local_cost, row, arg, True, p, q, klo, khi, dlo, dhi, ds, sj, prior, lmbda, threads)
+
+def _checkpoint_stride(J, K, max_memory):
+    """
+        the number of rows c between checkpoints in align_path:
+        ceil((J-1)/c) checkpointed float32 rows plus a c x K block of int32 backpointers
+    """
+    rows = lambda c: -(-(J-1)//c) + c
+    if max_memory is None: return max(1,int(np.ceil(np.sqrt(J-1)))) # minimize memory
+
+    budget = max_memory//(4*K) - 8 # leave room for the working rows
+    feasible = [c for c in range(1,J) if rows(c) <= budget]
+    if not feasible:
+        raise MemoryError('align_path needs at least {} bytes'.format(4*K*(8 + min(rows(c) for c in range(1,J)))))
+    return max(feasible) # fewest recomputed rows
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cpdef align_path(const np.uint64_t[:,:] score, const float[:] score_timing, const np.uint64_t[:,:] perf,
+                 float ds, float lmbda, engine='fast', band=None, window=None, max_memory=None, int threads=1):
+    """
+        memory-bounded alternative to backtrack(align(..., backpointers=True)[1])
+
+        rather than materializing J x K matrices we keep only every c'th row of L (checkpoints);
+        the path is recovered segment by segment (last to first), recomputing the rows of each
+        segment from its checkpoint and recording backpointers for just those rows
+
+        max_memory bounds the size in bytes of the DP state (defaults to the minimum, c ~ sqrt(J));
+        local costs are recomputed as needed, so the work is at most twice that of align
+    """
+    if engine not in engines: raise ValueError('Unknown engine: {}'.format(engine))
+    if threads < 1: raise ValueError('threads must be positive')
+
+    cdef int J = score.shape[0]
+    cdef int K = perf.shape[0]
+    cdef float prior = (ds*K)/np.cumsum(score_timing)[len(score_timing)-1] # slope = rise/run
+
+    npdlo,npdhi = band_limits(score_timing, K, ds, band)
+    cdef int[:] dlo = npdlo
+    cdef int[:] dhi = npdhi
+
+    npa,npb = reachable(K, npdlo, npdhi, window)
+    cdef int[:] a = npa
+    cdef int[:] b = npb
+
+    cdef int c = _checkpoint_stride(J, K, max_memory) if J > 1 else 1
+    cdef int[:,:] B = np.full((c+1,K), -1, dtype=np.int32)
+    cdef float[:,:] checkpoints = np.full(((J-2)//c+1,K), np.inf, dtype=np.float32)
+    cdef float[:,:] rows = np.empty((2,K), dtype=np.float32)
+    cdef float[:] local_cost = np.empty(K, dtype=np.float32)
+    cdef double[:] Q = np.zeros(K+1, dtype=np.float64)
+
+    cdef np.ndarray[np.int32_t, ndim=1] npP = np.empty(J, dtype=np.int32)
+    cdef int[:] P = npP
+    cdef int j,j0,j1,k
+    cdef bint fast = engine == 'fast'
+    if J == 1: return np.array([K-1], dtype=np.int32)
+
+    # forward pass: fill in the checkpoints at rows 0, c, 2c, ...
+    with nogil:
+        if a[0] <= b[0]:
+            _local_cost_row(score, perf, 0, local_cost, 0, b[0], threads)
+            _row_base(local_cost, checkpoints[0], b[0], ds, score_timing[0], prior, lmbda)
+            checkpoints[0,:a[0]] = INFINITY
+        rows[0,:] = checkpoints[0]
+        for j in range(1,c*(checkpoints.shape[0]-1)+1):
+            _advance(score, perf, j, rows[(j-1)%2], rows[j%2], B[0], local_cost, Q, fast,
+                     a[j-1], b[j-1], a[j], b[j], dlo[j], dhi[j], ds, score_timing[j], prior, lmbda, threads)
+            if j % c == 0: checkpoints[j//c,:] = rows[j%2]
+
+    # backward pass: recompute each segment (j0,j1] with backpointers and trace it back
+    k = K-1
+    for j0 in range(c*(checkpoints.shape[0]-1),-1,-c):
+        j1 = min(j0+c,J-1)
+        rows[0,:] = checkpoints[j0//c]
+        with nogil:
+            for j in range(j0+1,j1+1):
+                _advance(score, perf, j, rows[(j-j0-1)%2], rows[(j-j0)%2], B[j-j0], local_cost, Q, fast,
+                         a[j-1], b[j-1], a[j], b[j], dlo[j], dhi[j], ds, score_timing[j], prior, lmbda, threads)
+        for j in range(j1,j0,-1):
+            P[j] = k
+            k = B[j-j0,k]
+            if k < 0: raise ValueError('No alignment path reaches the final state')
+    P[0] = k
+
+    return npP
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef backtrack(int[:,:] B):
+    """
+        follow the backpointers recorded by align(..., backpointers=True) from the final state
+
+        returns an int array whose j'th entry is the performance frame k at which score event j ends
+    """
+    cdef int J = B.shape[0]
+    cdef np.ndarray[np.int32_t, ndim=1] npP = np.empty(J, dtype=np.int32)
+    cdef int[:] P = npP
+    cdef int j
+    cdef int k = B.shape[1]-1
+    for j in range(J-1,0,-1):
+        P[j] = k
+        k = B[j,k]
+        if k < 0: raise ValueError('No alignment path reaches the final state')
+    P[0] = k
+
+    return npP
+
+def traceback(score, score_timing, perf, L, ds, lmbda, engine='fast', band=None):
+    if not np.isfinite(L[len(score)-1,len(perf)-1]):
+        raise ValueError('No alignment path within the tempo band {}'.format(band))
+
+    score_timing = np.asarray(score_timing, dtype=np.float32)
+    dlo,dhi = band_limits(score_timing, len(perf), ds, band)
+    if engine == 'fast': return _traceback_argmin(score, score_timing, perf, L, ds, lmbda, dlo, dhi)
 
-    L[0,0] = 0 # base case
-    # k > 0 is unreachable when j = 0 (no up moves allowed) so leave L[0,k] = np.inf for k > 0
-    for j in range(1,len(score)): # x-axis (score)
-        sj = score_timing[j]
-        for k in range(0,len(perf)): # y-axis (performance)
-            incremental_cost = 0
-            # go backward to incrementally compute mean cost
-
-            # limit tempo search to [.5*prior,2*prior)
-            #minm = max(0,k - int(2*prior*sj/ds))
-            #maxm = min(k+1,k - int(.5*prior*sj/ds))
-            #for m in reversed(range(minm,maxm)): # unrestricted range would be range(0,k+1)
-            for m in reversed(range(0,k+1)):
-                # instantaneous tempo over score event j is
-                # elapsed duration in the performance (k-m)*ds divided by elapsed time in the score score_timing[j]
-                instantaneous_tempo = ((k-m)*ds)/sj
-                #if instantaneous_tempo < .5*prior or instantaneous_tempo > 2*prior: continue
-
-                # I *think* the python power operator translates to the same as repeat multiply here
-                # but in the non-cython setting (i.e. traceback it casts to 64-bit) so we need to
-                # do the multiply manually in numpy 32-bit floats over there; doing the same here
-                # seems safest...
-                tmp = instantaneous_tempo - prior
-                R = lmbda*tmp*tmp
-
-                # cost is cost of advancing from previous state L[j-1,m]
-                # plus the cost of aligning score[j] to (performance[m],performance[k]]
-                # plus regularization for the tempo required to make this step
-                cost = L[j-1,m] + incremental_cost*ds + R
-
-                # track the minimum cost to reach state L[j,k]
-                if cost < L[j,k]: L[j,k] = cost
-
-                # the cost of aligning score[j] to (performance[m],...,performance[k]]
-                #     =  cost of aligning score[j] to (performance[m+1],...,performance[k]]
-                #     + cost of aligning score[j] 
-                #     = int_{m}^k \|score[j] - perf[m]\|_1 \,dt
-                incremental_cost += local_cost[j,m]
-
-    return npL
-
-def traceback(score, perf, L, ds, lmbda):
     # 32-bit arithmetic so that floating-point equalities work out
     ds = np.float32(ds)
     lmbda = np.float32(lmbda)
 
-    score_timing = score[:,128]
     prior = (ds*np.float32(len(perf)))/np.cumsum(score_timing)[len(score_timing)-1]
 
     A,C = [],[]
     k = len(perf)-1
     for j in reversed(range(1,len(score))):
         sj = score_timing[j]
+        local = local_cost(score, perf, j)
         incremental_cost = np.float32(0)
-        for m in reversed(range(0,k+1)):
+        for m in reversed(range(max(0,k-dhi[j]),k+1)):
             instantaneous_tempo = ((np.float32(k)-np.float32(m))*ds)/sj
-            #if instantaneous_tempo < .5*prior or instantaneous_tempo > 2*prior: continue
 
             tmp = instantaneous_tempo - prior
             R = lmbda*tmp*tmp
 
-            if L[j,k] == L[j-1,m] + incremental_cost*ds + R:
+            if k-m >= dlo[j] and L[j,k] == L[j-1,m] + incremental_cost*ds + R:
                 A.append((j,k))
                 C.append(L[j,k])
                 k = m
                 break      # found the match
 
-            for i in range(128):
-                tmp = score[j,i] - perf[m,i]
-                incremental_cost += tmp if tmp > 0 else -tmp
+            incremental_cost += local[m]
 
         else: assert False # we had to come from somewhere...
 
@@ -114,3 +566,29 @@ def traceback(score, perf, L, ds, lmbda):
     C.append(L[0,k])
 
     return list(reversed(A)),list(reversed(C))
+
+def _traceback_argmin(score, score_timing, perf, L, ds, lmbda, dlo, dhi):
+    # the fast engine doesn't reproduce the legacy float32 arithmetic,
+    # so recover each step as the (rightmost) minimizing predecessor instead
+    ds = np.float64(np.float32(ds))
+    lmbda = np.float64(np.float32(lmbda))
+
+    prior = np.float64((np.float32(ds)*np.float32(len(perf)))/np.cumsum(score_timing)[len(score_timing)-1])
+
+    A,C = [],[]
+    k = len(perf)-1
+    for j in reversed(range(1,len(score))):
+        sj = np.float64(score_timing[j])
+        Q = np.concatenate(([0],np.cumsum(local_cost(score, perf[:k+1], j), dtype=np.float64)))
+        m = np.arange(k+1)
+        tmp = ((k-m)*ds)/sj - prior
+        cost = L[j-1,:k+1] + ds*(Q[k+1]-Q[m+1]) + lmbda*tmp*tmp
+        cost[(k-m < dlo[j]) | (k-m > dhi[j])] = np.inf
+        A.append((j,k))
+        C.append(L[j,k])
+        k = k - int(np.argmin(cost[::-1]))
+
+    A.append((0,k))
+    C.append(L[0,k])
+
+    return list(reversed(A)),list(reversed(C))
@@ -0,0 +1,157 @@
+import os, sys, json, time, resource, cProfile, functools
+
+#
+# lightweight instrumentation of the alignment pipeline
+#
+# code marks the stages of its work with `with instrument.stage(name):` or @instrument.timed(name)
+# (stages nest, and are recorded by their path, e.g. 'features/synthesize') and records values such
+# as matrix sizes with instrument.record(J=..., K=...); a job (the alignment or evaluation of one
+# performance) collects them, with its time and peak memory. Unless instrumentation is enabled, stage() returns a shared no-op
+# context manager and record() returns immediately, so instrumented code runs at full speed
+#
+# jobs run in pool workers return their measurements to the main process, which writes them as JSON
+# lines (see write) and summarizes them across jobs (see report)
+#
+
+enabled = bool(os.environ.get('ALIGN_INSTRUMENT'))
+profile_job = None # the name of a job to run under cProfile (its stats are written to <name>.prof)
+
+_stages = {} # stage path -> [seconds, calls], for the current job
+_values = {} # recorded values, for the current job
+_repeated = set() # the names of values recorded more than once (whose values are collected in lists)
+_path = []   # the names of the open stages
+
+def configure(enable, profile=None):
+    """ enable (or disable) instrumentation, and choose a job to profile """
+    global enabled, profile_job
+    enabled = enable
+    profile_job = profile
+
+class _Stage:
+    __slots__ = ('name', 't0')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        _path.append(self.name)
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.t0
+        entry = _stages.setdefault('/'.join(_path), [0., 0])
+        entry[0] += seconds
+        entry[1] += 1
+        _path.pop()
+
+class _Disabled:
+    __slots__ = ()
+    def __enter__(self): pass
+    def __exit__(self, *exc): pass
+
+_disabled = _Disabled()
+
+def stage(name):
+    """ a context manager that times a stage of the current job (nested in any open stages) """
+    return _Stage(name) if enabled else _disabled
+
+def timed(name):
+    """ decorator: time every call of a function as a stage """
+    def decorate(f):
+        @functools.wraps(f)
+        def timed_f(*args, **kwargs):
+            with stage(name): return f(*args, **kwargs)
+        return timed_f
+    return decorate
+
+def record(**values):
+    """
+        record named values (e.g. the sizes of the matrices computed) for the current job; a value
+        recorded several times in a job (e.g. for each performance of a batch) becomes a list
+    """
+    if not enabled: return
+    for name,value in values.items():
+        if name in _repeated: _values[name].append(value)
+        elif name in _values:
+            _values[name] = [_values[name], value]
+            _repeated.add(name)
+        else:
+            _values[name] = value
+
+class job:
+    """
+        context manager measuring one job: `with instrument.job(name) as measured:` fills the dict
+        measured with its name, seconds and peak memory (MB) and, if enabled, its stages and values
+    """
+    def __init__(self, name):
+        self.measured = dict(job=name)
+
+    def __enter__(self):
+        _stages.clear()
+        _values.clear()
+        _repeated.clear()
+        reset_peak_rss()
+        self.profiler = cProfile.Profile() if self.measured['job'] == profile_job else None
+        self.t0 = time.time()
+        if self.profiler is not None: self.profiler.enable()
+        return self.measured
+
+    def __exit__(self, *exc):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.measured['profile'] = self.measured['job'] + '.prof'
+            self.profiler.dump_stats(self.measured['profile'])
+        self.measured['seconds'] = time.time() - self.t0
+        self.measured['peak_rss_mb'] = peak_rss_mb()
+        if enabled:
+            self.measured['stages'] = {path: dict(seconds=s, calls=n) for path,(s,n) in _stages.items()}
+            self.measured['values'] = dict(_values)
+
+def write(filename, measured, **fields):
+    """ append a job's measurements (with any other fields) to a JSON lines file """
+    with open(filename, 'a') as f: f.write(json.dumps(dict(fields, **measured)) + '\n')
+
+def report(jobs, file=sys.stdout):
+    """ print the time spent in each stage, summed over the measurements of several jobs """
+    total = sum(measured['seconds'] for measured in jobs)
+    stages = {}
+    for measured in jobs:
+        for path,entry in measured.get('stages', {}).items():
+            seconds,calls = stages.get(path, (0., 0))
+            stages[path] = (seconds + entry['seconds'], calls + entry['calls'])
+    if not stages: return
+
+    print('{:<40}{:>12}{:>8}{:>8}'.format('stage', 'seconds', '%', 'calls'), file=file)
+    for path in sorted(stages):
+        seconds,calls = stages[path]
+        name = '  '*path.count('/') + path.rsplit('/', 1)[-1]
+        print('{:<40}{:>12.3f}{:>8.1f}{:>8}'.format(name, seconds, 100*seconds/total if total > 0 else 0, calls), file=file)
+    print('{:<40}{:>12.3f}{:>8}{:>8}  (peak {:.0f}MB)'.format('total (jobs)', total, 100, len(jobs),
+          max(measured['peak_rss_mb'] for measured in jobs)), file=file)
+
+def rss_mb():
+    """ the resident set size of this process in MB (None where unavailable) """
+    return _status_mb('VmRSS')
+
+def reset_peak_rss():
+    try: # linux: reset the peak resident set size (VmHWM) of this process
+        with open('/proc/self/clear_refs', 'w') as f: f.write('5')
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    """ the peak resident set size of this process in MB, since reset_peak_rss (on linux) """
+    peak = _status_mb('VmHWM')
+    if peak is not None: return peak
+
+    # peak over the life of the (worker) process; ru_maxrss is in bytes on macOS, kB elsewhere
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss/2**20 if sys.platform == 'darwin' else maxrss/2**10
+
+def _status_mb(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'): return int(line.split()[1])/2**10
+    except OSError:
+        pass
@@ -1,6 +1,29 @@
 import numpy as np
 import mido
 
+import lib.cache as cache
+import lib.instrument as instrument
+
+cached = False # cache parsed midi files (see configure)
+
+# the version of the parsers, part of the key of cached parses: bump it when _parse_midi or
+# _parse_midi_events changes what they return, so parses cached by an older version aren't used
+parser_version = 1
+
+def configure(cache_parses):
+    """
+        cache parsed midi files in the cache directory (see lib.cache), e.g. for align.py, which
+        parses every file in the main process and again in its workers; off by default, so that
+        loading a midi file doesn't write to the cache directory (./cache) of the caller
+    """
+    global cached
+    cached = cache_parses
+
+def _load(kind, filename, params, parse):
+    """ the arrays parsed from filename, from the cache if parses are cached """
+    if not cached: return parse()
+    return cache.load_arrays(kind, [filename], dict(params, parser=parser_version), parse)
+
 def load_midi(filename):
     """
         input: a midi file given by path 'filename'
@@ -13,11 +36,20 @@ def load_midi(filename):
             offset - real-valued time in seconds
 
         the list of notes is sorted by onset time
+
+        parsed notes are cached if enabled (see configure)
     """
+    arrays = _load('notes', filename, {}, lambda: _parse_midi(filename))
+    notes = list(zip(arrays['pitch'].tolist(), arrays['onset'].tolist(), arrays['offset'].tolist()))
+
+    return notes, int(arrays['ticks_per_beat'])
 
+@instrument.timed('parse midi')
+def _parse_midi(filename):
     midi = mido.MidiFile(filename)
 
     notes = []
+    last = {} # index of the last note played at each pitch
     time = 0
     for message in midi:
         time += message.time
@@ -28,15 +60,14 @@ def load_midi(filename):
             # but not intended to be played? (e.g. ravel)
             #if message.channel==0:
             #    continue
+            last[message.note] = len(notes)
             notes.append((message.note, time, -1))
         elif (message.type == 'note_off') or (message.type == 'note_on' and message.velocity == 0):
             # Find the last time this note was played and update that
             # entry with offset.
-            for i, e in reversed(list(enumerate(notes))):
-                (note, onset, offset) = e
-                if note == message.note:
-                    notes[i] = (note, onset, time)
-                    break
+            if message.note in last:
+                i = last[message.note]
+                notes[i] = (message.note, notes[i][1], time)
 
     # only keep the entries with have an offset
     notes = [x for x in notes if not x[2] == -1]
@@ -45,7 +76,25 @@ def load_midi(filename):
     for note, onset, offset in notes: assert onset <= offset
     assert time == midi.length
 
-    return notes, midi.ticks_per_beat
+    pitch,onset,offset = [np.array(v) for v in zip(*notes)] if notes else [np.zeros(0)]*3
+    return dict(pitch=pitch.astype(np.int64), onset=onset.astype(np.float64), offset=offset.astype(np.float64),
+                ticks_per_beat=np.array(midi.ticks_per_beat))
+
+
+def pack_pitches(x):
+    """
+        pack binary pitch indicators x in {0,1}^{T x 128} into bitmasks in uint64^{T x 2}
+
+        pitch i is stored in bit i%64 of word i//64
+    """
+    x = np.asarray(x, dtype=bool).reshape(-1,128)
+    return np.packbits(x, axis=1, bitorder='little').view('<u8').astype(np.uint64)
+
+
+def unpack_pitches(bits):
+    """ inverse of pack_pitches: returns binary pitch indicators in {0,1}^{T x 128} """
+    bits = np.ascontiguousarray(bits, dtype='<u8').reshape(-1,2)
+    return np.unpackbits(bits.view(np.uint8), axis=1, bitorder='little')
 
 
 def load_midi_events(filename, merge=True, strip_ends=True):
@@ -67,40 +116,68 @@ def load_midi_events(filename, merge=True, strip_ends=True):
 
           (2) the time of the first onset in the performance (t=0)
           (3) the time of the last onset in the performance (t=T)
+
+        see load_midi_events_packed for a compact version of the same events
     """
+    pitches,durations,first_onset,last_onset = load_midi_events_packed(filename, merge, strip_ends)
+    events = np.empty((len(durations),129))
+    events[:,:128] = unpack_pitches(pitches)
+    events[:,128] = durations
+
+    return events,first_onset,last_onset
+
+
+def load_midi_events_packed(filename, merge=True, strip_ends=True):
+    """
+        same as load_midi_events, but returns the events in a compact form:
+
+          (1) pitch sets in uint64^{T x 2} (see pack_pitches)
+          (2) durations in R^T
+          (3) the time of the first onset in the performance (t=0)
+          (4) the time of the last onset in the performance (t=T)
+
+        parsed events are cached if enabled (see configure)
+    """
+    arrays = _load('events', filename, dict(merge=merge, strip_ends=strip_ends),
+                   lambda: _parse_midi_events(filename, merge, strip_ends))
+
+    return arrays['pitches'],arrays['durations'],arrays['first_onset'].item(),arrays['last_onset'].item()
+
+@instrument.timed('parse midi')
+def _parse_midi_events(filename, merge, strip_ends):
     midi = mido.MidiFile(filename)
 
-    events = []
+    pitches = []
+    durations = []
 
     time = 0
-    cur_event = np.zeros(129)
+    cur_event = [0,0] # bitmasks for pitches [0,64) and [64,128)
     last_onset = 0
     for message in midi:
         time += message.time
         if message.time != 0:
-            if merge and len(events) > 0 and np.array_equal(cur_event[:128], events[-1][:128]):
-                events[-1][-1] += message.time
+            if merge and len(pitches) > 0 and pitches[-1] == tuple(cur_event):
+                durations[-1] += message.time
             else:
-                cur_event[-1] = message.time
-                events.append(cur_event)
-                cur_event = np.copy(cur_event)
-                cur_event[-1] = 0 
+                pitches.append(tuple(cur_event))
+                durations.append(message.time)
 
         if message.type == 'note_on' and message.velocity != 0:
-            cur_event[message.note] = 1
+            cur_event[message.note//64] |= 1 << (message.note%64)
             last_onset = time
         elif (message.type == 'note_off') or (message.type == 'note_on' and message.velocity == 0):
-            cur_event[message.note] = 0
+            cur_event[message.note//64] &= ~(1 << (message.note%64))
 
     first_onset = 0
-    if not np.any(events[0][:128]):
-        first_onset = events[0][-1]
-        if strip_ends: events = events[1:]
+    if pitches[0] == (0,0):
+        first_onset = durations[0]
+        if strip_ends: pitches,durations = pitches[1:],durations[1:]
 
-    if not np.any(events[-1][:128]) and strip_ends:
-        events = events[:-1]
+    if pitches[-1] == (0,0) and strip_ends:
+        pitches,durations = pitches[:-1],durations[:-1]
 
-    return np.stack(events),first_onset,last_onset
+    return dict(pitches=np.array(pitches, dtype=np.uint64).reshape(-1,2), durations=np.array(durations, dtype=np.float64),
+                first_onset=np.array(first_onset), last_onset=np.array(last_onset))
 
 
 def write_midi(filename, notes, tpb):
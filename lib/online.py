@@ -0,0 +1,87 @@
+import numpy as np
+import librosa, soundfile, soxr
+from scipy.spatial.distance import cdist
+
+import lib.dtw as dtw
+
+#
+# online (streaming) score following, in the manner of Dixon's online time warping (OLTW)
+#
+# performance audio arrives in blocks of samples; each block completes zero or more feature frames,
+# and each performance frame t extends a forward DTW against the (precomputed) score frames by one
+# row. The row is limited to the score frames within radius of the current score position, so the
+# work and memory per block are constant. The score position after frame t is the cell of the row
+# with the lowest path-length normalized cost
+#
+
+def audio_blocks(wav, fs, block=2048):
+    """
+        the samples of a wav file (mixed down to mono) in blocks, as they would arrive from a live input;
+        a file sampled at another rate than fs is resampled as it streams (with soxr, which librosa.load
+        also uses), so the blocks are then of varying length
+    """
+    rate = soundfile.info(wav).samplerate
+    resampler = soxr.ResampleStream(rate, fs, 1, dtype='float32', quality='HQ') if rate != fs else None
+
+    for samples in soundfile.blocks(wav, blocksize=block, dtype='float32', always_2d=True):
+        samples = samples.mean(axis=1)
+        yield samples if resampler is None else resampler.resample_chunk(samples)
+    if resampler is not None: yield resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+
+def log_chroma(audio, fs=44100, stride=512, n_fft=4096, filterbank=None):
+    """
+        log-chroma frames (T x 12) of audio: L2-normalized chroma in dB (relative to 1)
+
+        frame t covers the samples [t*stride, t*stride+n_fft), so frames can be computed as soon as their
+        samples arrive; unlike align_chroma's features, frames are not centered and the dB reference
+        doesn't depend on the loudest frame
+    """
+    if len(audio) < n_fft: return np.zeros((0,12))
+    if filterbank is None: filterbank = librosa.filters.chroma(sr=fs, n_fft=n_fft, tuning=0)
+
+    spec = np.abs(librosa.stft(y=audio, n_fft=n_fft, hop_length=stride, center=False))**2
+    chroma = librosa.util.normalize(np.dot(filterbank, spec), norm=2, axis=0)
+    return librosa.power_to_db(chroma, ref=1., top_db=None).T
+
+def chroma_blocks(blocks, fs=44100, stride=512, n_fft=4096):
+    """ the log-chroma frames (see log_chroma) completed by each block of samples """
+    filterbank = librosa.filters.chroma(sr=fs, n_fft=n_fft, tuning=0)
+    buffered = np.zeros(0, dtype=np.float32) # samples not yet consumed by a complete frame
+    for block in blocks:
+        buffered = np.concatenate([buffered, block])
+        frames = 0 if len(buffered) < n_fft else 1 + (len(buffered) - n_fft)//stride
+        yield log_chroma(buffered[:(frames-1)*stride + n_fft], fs, stride, n_fft, filterbank)
+        buffered = buffered[frames*stride:]
+
+def follow(score, blocks, radius=256):
+    """
+        follow a performance through the score features score (N x d), given the performance
+        features in blocks of frames (e.g. from chroma_blocks)
+
+        yields, for each block, the score frame reached at each of the block's performance frames
+        (the reported score frame never moves backwards)
+    """
+    N = len(score)
+    score = np.ascontiguousarray(score, dtype=np.float64)
+
+    t,position,reached = 0,0,0
+    prev,plo,phi = np.zeros(0),0,-1
+    for frames in blocks:
+        positions = np.empty(len(frames), dtype=np.int64)
+        for i,frame in enumerate(frames):
+            lo,hi = max(0, position - radius),min(N-1, position + radius)
+
+            # local costs of this performance frame, within radius of the score position
+            C = cdist(np.asarray(frame, dtype=np.float64)[None], score[lo:hi+1])[0]
+            row = np.empty(hi-lo+1)
+            dtw.accumulate(C, prev, row, plo, phi, lo, hi, first=t == 0, diagonal=2.)
+
+            # with the diagonal step weighted twice, every path to (t,j) has total weight t+j+1
+            position = lo + int(np.argmin(row/(t + np.arange(lo, hi+1) + 1)))
+            reached = max(reached, position)
+            positions[i] = reached
+
+            prev,plo,phi = row,lo,hi
+            t += 1
+
+        yield positions
@@ -0,0 +1,74 @@
+import os, json
+import numpy as np
+
+#
+# alignment store: the alignments (and any other per-performance arrays, e.g. online latencies)
+# of one algorithm, kept in a single binary container in its output directory (align/<algo>):
+#
+#   arrays.bin   - float64 values of every stored array, back to back
+#   index.jsonl  - one entry per stored performance: its record (parameters, inputs, timings, ...)
+#                  and the byte offset and shape of each of its arrays in arrays.bin
+#
+# the store is append-only, so a run can be interrupted at any point: arrays whose index entry was
+# never written are ignored, and the latest entry for a performance supersedes any earlier ones.
+# readers memory-map the arrays, so loading a piece copies nothing
+#
+
+DATA = 'arrays.bin'
+INDEX = 'index.jsonl'
+
+def append(storedir, record, arrays):
+    """ store the named arrays of a performance (record['performance']) along with its record """
+    entry = dict(record, arrays={})
+    with open(os.path.join(storedir, DATA), 'ab') as f:
+        f.seek(0, os.SEEK_END)
+        for name,x in arrays.items():
+            x = np.ascontiguousarray(x, dtype=np.float64)
+            entry['arrays'][name] = [f.tell(), list(x.shape)]
+            f.write(x.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+    # written last: the arrays only become visible once they are complete
+    with open(os.path.join(storedir, INDEX), 'ab+') as f:
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n': f.write(b'\n') # terminate a partially written (interrupted) entry
+        f.write((json.dumps(entry) + '\n').encode())
+
+def index(storedir):
+    """ the latest index entry of each performance in the store (empty if there is no store) """
+    entries = {}
+    try:
+        with open(os.path.join(storedir, INDEX)) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # partially written (interrupted) entry
+                entries[entry['performance']] = entry
+    except FileNotFoundError:
+        pass
+
+    return entries
+
+def load(storedir, entry, name='alignment'):
+    """ the named array of an index entry, memory-mapped (read-only) from the store """
+    offset,shape = entry['arrays'][name]
+    if np.prod(shape) == 0: return np.zeros(shape)
+    return np.memmap(os.path.join(storedir, DATA), dtype=np.float64, mode='r', offset=offset, shape=tuple(shape))
+
+def load_alignment(directory, performance):
+    """
+        the alignment of a performance computed into directory: from the store if there is one,
+        otherwise from the text file performance.txt written by older versions of align.py
+    """
+    entry = index(directory).get(performance)
+    if entry is not None: return load(directory, entry)
+    return np.loadtxt(os.path.join(directory, performance + '.txt'))
+
+def export_text(storedir, outdir=None):
+    """ write each stored alignment as text (performance.txt, readable by np.loadtxt) to outdir (default storedir) """
+    if outdir is None: outdir = storedir
+    for performance,entry in index(storedir).items():
+        np.savetxt(os.path.join(outdir, performance + '.txt'), load(storedir, entry), fmt='%f\t', header='score\t\tperformance')
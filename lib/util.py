@@ -1,10 +1,9 @@
 import re
 
-import matplotlib.pyplot as plt
-from matplotlib import colors
-
 import numpy as np
 
+import lib.midi as midi
+
 def map_score(perf):
     """ associate a performance midi with a kern score based on filename conventions """
     regex = re.compile('(\d\d\d)_bwv(\d\d\d)(f|p)')
@@ -18,49 +17,131 @@ def map_score(perf):
 
 def plot_events(ax, events, stride=512, num_windows=2000):
     timings = np.cumsum(events[:,-1])
-    x = np.zeros([num_windows,128])
-    for i in range(num_windows):
-        time = (stride*i)/44100.
-        k = np.argmin(time>=timings)
-        x[i] = events[k,:128]
+    x = events[_first_after(timings, (stride*np.arange(num_windows))/44100.), :128]
 
     ax.imshow(x.T[::-1][30:90], interpolation='none', cmap='Greys', aspect=num_windows/250)
 
 def colorplot(ax, x, y, aspect=4):
+    from matplotlib import colors # only needed for plotting
     cmap = colors.ListedColormap(['white','red','orange','black'])
     bounds = [0,1,2,3,4]
     norm = colors.BoundaryNorm(bounds, cmap.N)
-    ax.imshow(x.T*2 + y.T, interpolation='none', cmap=cmap, aspect=aspect, norm=norm)
+    ax.imshow(diffmask(x, y).T, interpolation='none', cmap=cmap, aspect=aspect, norm=norm)
+
+def _first_ending(timing, t):
+    """
+        index of the first event with timing >= t, for each t (vectorized np.argmin(t>timing))
+        timing must be nondecreasing; as with argmin, times past the last event map to event 0
+    """
+    idx = np.searchsorted(timing, t, side='left')
+    idx[idx == len(timing)] = 0
+    return idx
+
+def _first_after(timing, t):
+    """ index of the first event with timing > t, for each t (vectorized np.argmin(t>=timing)) """
+    idx = np.searchsorted(timing, t, side='right')
+    idx[idx == len(timing)] = 0
+    return idx
 
-def pianoroll(events, fs=44100, stride=512):
+def pianoroll(events, fs=44100, stride=512, packed=False):
+    """
+        frames of the notes sounding at each time i*stride/fs; in {0,1}^{T x 128}
+        or (if packed) as bitmasks in uint64^{T x 2} (see midi.pack_pitches)
+    """
     notes = events[:,:-1]
     timing = np.cumsum(events[:,-1])
     num_windows = int(timing[-1]*(44100./stride))+1
-    
-    x = np.zeros([num_windows,128])
-    for i in range(num_windows):
-        t = (i*stride)/fs
-        x[i] = notes[np.argmin(t>timing)]
-        
-    return x
-        
-def pscore(score, alignment, stride=512, start=False):
-    epsilon = 1e-4
-    notes = score[:,:-1]
-    score_time, perf_time = zip(*alignment)
+
+    notes = midi.pack_pitches(notes) if packed else notes.astype(np.float64, copy=False)
+    return notes[_first_ending(timing, (np.arange(num_windows)*stride)/fs)]
+
+def pianoroll_packed(pitches, durations, fs=44100, stride=512):
+    """ pianoroll of packed events (see midi.load_midi_events_packed); returns frames in uint64^{T x 2} """
+    timing = np.cumsum(durations)
+    num_windows = int(timing[-1]*(44100./stride))+1
+
+    return pitches[_first_ending(timing, (np.arange(num_windows)*stride)/fs)]
+
+def pscore(score, alignment, stride=512, start=False, packed=False):
+    """
+        performance-aligned score: frames of the score notes that the alignment maps to each
+        performance time i*stride/44100; in {0,1}^{T x 128} or (if packed) uint64^{T x 2}
+    """
+    alignment = np.asarray(alignment, dtype=np.float64).reshape(-1,2)
     num_windows = int(alignment[-1][1]*(44100./stride))+1
-    
-    x = np.zeros([num_windows,128])
-    for i in range(num_windows):
-        t = (i*stride)/44100.                           # time (in seconds) in the performance
-        if start:                                       # if start time is given
-            if t < perf_time[0]: continue
-
-        j = np.argmin(t>np.array(perf_time))            # index of the first event in performance that ends after time t
-        s = score_time[j]                               # time (in beats) in the score
-        if s > np.sum(score[:,-1]): continue
-        k = np.argmin(s>np.cumsum(score[:,-1])+epsilon) # index of the first event in score that ends after time s
-        x[i] = notes[k]
-    
+    t = (np.arange(num_windows)*stride)/44100.                # time (in seconds) in the performance
+
+    return _pscore(_score_timing(score, packed), alignment, t, start)
+
+def window(t0, t1, fs=44100, stride=512):
+    """ the indices i of the frames at times i*stride/fs in the range [t0, t1) seconds """
+    return np.arange(max(0, int(np.ceil(t0*fs/stride))), max(0, int(np.ceil(t1*fs/stride))))
+
+def pianoroll_window(events, t0, t1, fs=44100, stride=512, packed=False):
+    """
+        the frames of pianoroll(events, fs, stride, packed) in the time range [t0, t1) seconds,
+        computed only for that range (frames past the end of the performance are silent)
+    """
+    notes = midi.pack_pitches(events[:,:-1]) if packed else events[:,:-1].astype(np.float64, copy=False)
+    timing = np.cumsum(events[:,-1])
+    num_windows = int(timing[-1]*(44100./stride))+1
+
+    i = window(t0, t1, fs, stride)
+    x = np.zeros((len(i),) + notes.shape[1:], dtype=notes.dtype)
+    keep = i < num_windows
+    x[keep] = notes[_first_ending(timing, (i[keep]*stride)/fs)]
     return x
 
+def pscore_window(score, alignments, t0, t1, stride=512, start=False, packed=False):
+    """
+        the frames of pscore(score, alignment, stride, start, packed) in the time range [t0, t1)
+        seconds, for each of a list of alignments; returns a list of rolls. The score is prepared
+        once for all of them, and only the frames in the range are computed (frames past the end of
+        an alignment are silent)
+    """
+    score_timing = _score_timing(score, packed)
+    i = window(t0, t1, 44100, stride)
+    t = (i*stride)/44100.
+
+    rolls = []
+    for alignment in alignments:
+        alignment = np.asarray(alignment, dtype=np.float64).reshape(-1,2)
+        keep = i < int(alignment[-1][1]*(44100./stride))+1
+        x = np.zeros((len(i),) + score_timing[0].shape[1:], dtype=score_timing[0].dtype)
+        x[keep] = _pscore(score_timing, alignment, t[keep], start)
+        rolls.append(x)
+
+    return rolls
+
+def diffmask(x, y):
+    """
+        compare two rolls (e.g. a performance and a performance-aligned score, or the ground truth
+        and a candidate) frame by frame: 0 where neither has a note, 1 where only y does, 2 where only
+        x does and 3 where both do (the colors of colorplot); packed rolls are unpacked
+    """
+    x,y = [midi.unpack_pitches(v) if v.dtype == np.uint64 else v for v in (x,y)]
+    return 2*(np.asarray(x) > 0).astype(np.uint8) + (np.asarray(y) > 0)
+
+def _score_timing(score, packed):
+    """ what pscore needs of a score: its notes, the cumulative timing of its events and its length """
+    notes = midi.pack_pitches(score[:,:-1]) if packed else score[:,:-1].astype(np.float64, copy=False)
+    return notes, np.cumsum(score[:,-1]), np.sum(score[:,-1])
+
+def _pscore(score_timing, alignment, t, start):
+    """ frames of the score notes that the alignment maps to each performance time t (see pscore) """
+    epsilon = 1e-4
+    notes,timing,length = score_timing
+    score_time, perf_time = alignment[:,0], alignment[:,1]
+
+    # index of the first event in performance that ends after time t
+    # (the first event whose time >= t is the first whose running maximum time >= t)
+    s = score_time[_first_ending(np.maximum.accumulate(perf_time), t)] # time (in beats) in the score
+    keep = s <= length
+    if start: keep &= t >= perf_time[0]                       # if start time is given
+
+    # index of the first event in score that ends after time s
+    k = _first_ending(timing+epsilon, s[keep])
+    x = np.zeros((len(t),) + notes.shape[1:], dtype=notes.dtype)
+    x[keep] = notes[k]
+
+    return x
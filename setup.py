@@ -0,0 +1,23 @@
+#!/usr/bin/python3
+#
+# ahead-of-time build of the Cython extensions (lib/gtalign.pyx, lib/dtw.pyx):
+#
+#   python3 setup.py build_ext --inplace
+#
+# the compiled modules are placed next to their sources and imported in preference to compiling them
+# with pyximport (see lib/algos.py); rebuild after editing a .pyx file. The build settings (optimization,
+# OpenMP) are those of the .pyxbld file of each extension, so both builds use the same flags
+#
+import runpy
+from setuptools import setup
+from Cython.Build import cythonize
+
+def extension(name):
+    """ the extension lib.<name>, as configured by lib/<name>.pyxbld """
+    pyxbld = runpy.run_path('lib/{}.pyxbld'.format(name))
+    return pyxbld['make_ext']('lib.{}'.format(name), 'lib/{}.pyx'.format(name))
+
+setup(name='alignment-eval',
+      py_modules=[],
+      ext_modules=cythonize([extension('gtalign'), extension('dtw')],
+                            compiler_directives={'language_level': 3}))